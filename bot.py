@@ -1,19 +1,26 @@
+import abc
+import asyncio
+import functools
 import logging
 import random
 import requests
-from collections import deque
+from collections import deque, OrderedDict
 import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
@@ -25,9 +32,25 @@ from webdriver_manager.chrome import ChromeDriverManager
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 import supabase
 import os, sqlite3, datetime, threading
+import atexit
+import contextlib
+import hashlib
+import hmac
+import signal
+import sys
+import json
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from decimal import Decimal
+import lxml.html
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from pathlib import Path
-from flask import Flask, Response, render_template, make_response, jsonify
+from flask import Flask, Response, render_template, make_response, jsonify, request
 from datetime import timezone, timedelta, datetime
 from flask_cors import CORS
 
@@ -52,6 +75,55 @@ app = Flask(__name__)
 
 START_TS = time.time()
 
+class Metrics:
+    """Thread-safe counters and latency summaries served on /api/metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            t = self._timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            t["count"] += 1
+            t["total"] += seconds
+            t["max"] = max(t["max"], seconds)
+
+    def register_gauge(self, name, fn):
+        """Register a callable whose return value is reported under `name`"""
+        self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {
+                name: {
+                    "count": t["count"],
+                    "avg_ms": round(t["total"] / t["count"] * 1000, 1) if t["count"] else 0,
+                    "max_ms": round(t["max"] * 1000, 1),
+                }
+                for name, t in self._timings.items()
+            }
+        gauges = {}
+        for name, fn in list(self._gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {"counters": counters, "timings": timings, "gauges": gauges}
+
+metrics = Metrics()
+
 @app.route("/api/bot_info")
 def bot_info():
     uptime_seconds = int(time.time() - START_TS)
@@ -69,10 +141,21 @@ def bot_info():
     resp.headers['Access-Control-Allow-Origin'] = '*'   # allow all origins (safe for public read-only APIs)
     return resp
 
+@app.route("/api/metrics")
+def api_metrics():
+    resp = make_response(jsonify(metrics.snapshot()), 200)
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    return resp
+
 @app.route('/healthz')
 def health_check():
     return Response("OK", status=200)
 
+@app.route("/telegram/webhook", methods=["POST"])
+def telegram_webhook():
+    # Updates pushed by Telegram when WEBHOOK_URL is set (see TelegramWebhook)
+    return webhook.receive(request)
+
 @app.route('/') 
 def index():
     # serves templates/index.html
@@ -86,6 +169,8 @@ def help_page():
 TARGET_URL = os.getenv("TARGET_URL", "http://127.0.0.1:7070/healthz")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 10))   # seconds between probes
 HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", 10000)) 
+STATUS_TZ_HOURS = float(os.getenv("STATUS_TZ_HOURS", 0))  # default UTC offset of the status page's days (8 = MYT)
+DAILY_CACHE_SIZE = int(os.getenv("DAILY_CACHE_SIZE", 2000))  # finished (tz offset, day) counts kept in memory
 history = deque(maxlen=HISTORY_SIZE)
 PERSIST_HISTORY = os.getenv("PERSIST_HISTORY", "true").lower() in ("1","true","yes")
 DB_PATH = os.getenv("HISTORY_DB", "history.db")   # number of samples to keep
@@ -100,18 +185,21 @@ def init_db():
                     ok INTEGER NOT NULL,
                     rt INTEGER
                  )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pings_ts ON pings(ts, ok)")  # covers the daily aggregation
     conn.commit()
     return conn
 
-db_conn = init_db()
+db_conn = None  # opened by start_status_page()
+db_lock = threading.Lock()  # the poller writes while Flask threads read
 
 def save_ping(ts, ok, rt):
     if not PERSIST_HISTORY or db_conn is None:
         return
     try:
-        c = db_conn.cursor()
-        c.execute("INSERT INTO pings(ts, ok, rt) VALUES(?,?,?)", (ts, ok, rt))
-        db_conn.commit()
+        with db_lock:
+            c = db_conn.cursor()
+            c.execute("INSERT INTO pings(ts, ok, rt) VALUES(?,?,?)", (ts, ok, rt))
+            db_conn.commit()
     except Exception:
         # don't crash the poller because of DB issues
         pass
@@ -139,10 +227,6 @@ def poller():
         save_ping(ts, ok, rt_ms)
         time.sleep(POLL_INTERVAL)
 
-# start poller thread (ensure to start it once when app starts)
-t = threading.Thread(target=poller, daemon=True)
-t.start()
-
 # raw history endpoint (keeps backward compatibility)
 @app.route('/status_history')
 def status_history():
@@ -151,58 +235,80 @@ def status_history():
     return resp
 
 # helper: compute daily aggregates (reads DB if present, otherwise in-memory history)
+# Finished days never change, so their DB counts are cached per (tz offset, day number),
+# least recently used first
+_daily_cache = OrderedDict()
+_daily_lock = threading.Lock()
+
+def _day_counts_db(first_day, offset):
+    """{day number: (ok, total)} from first_day (local days at `offset` seconds from UTC) to today"""
+    with db_lock:
+        rows = db_conn.execute(
+            "SELECT (ts + ?) / 86400 AS day, SUM(ok), COUNT(*) FROM pings WHERE ts >= ? GROUP BY day",
+            (offset, first_day * 86400 - offset)
+        ).fetchall()
+    return {day: (ok, total) for day, ok, total in rows}
+
 def compute_daily_aggregates(days=90, tz_offset_hours=0):
     """Return list of (date_iso, ok_count, total_count, pct_ok) for last `days` days (inclusive of today)."""
-    now = int(time.time())
-    start_day_ts = now - days * 86400
-    # initialize per-day buckets (UTC)
-    result = []
-    # build day boundaries (UTC dates)
-    today = datetime.fromtimestamp(now, tz=timezone.utc).date()
-    days_list = [(today - timedelta(days=i)) for i in range(days-1, -1, -1)]  # oldest -> newest
-
-    # prepare counts
-    counts = {d.isoformat(): {"ok":0, "total":0} for d in days_list}
+    offset = int(tz_offset_hours * 3600)
+    today = (int(time.time()) + offset) // 86400          # day number in the requested timezone
+    day_numbers = range(today - days + 1, today + 1)       # oldest -> newest
 
     if PERSIST_HISTORY and db_conn is not None:
-        # read from sqlite
-        c = db_conn.cursor()
-        cutoff = int(time.time()) - days * 86400
-        for row in c.execute("SELECT ts, ok FROM pings WHERE ts >= ? ORDER BY ts ASC", (cutoff,)):
-            ts, ok = row
-            dt = datetime.fromtimestamp(ts, tz=timezone.utc).date().isoformat()
-            if dt in counts:
-                counts[dt]["total"] += 1
-                counts[dt]["ok"] += int(ok)
+        with _daily_lock:
+            counts = {}
+            for day in day_numbers:
+                if (offset, day) in _daily_cache:
+                    _daily_cache.move_to_end((offset, day))
+                    counts[day] = _daily_cache[(offset, day)]
+        # Only the days not cached yet (normally just today) are read, via the ts index
+        missing = [day for day in day_numbers if day not in counts]
+        if missing:
+            fresh = _day_counts_db(missing[0], offset)
+            with _daily_lock:
+                for day in missing:
+                    counts[day] = fresh.get(day, (0, 0))
+                    if day < today:
+                        _daily_cache[(offset, day)] = counts[day]
+                while len(_daily_cache) > DAILY_CACHE_SIZE:
+                    _daily_cache.popitem(last=False)
     else:
         # read from in-memory deque
+        counts = {}
+        cutoff = day_numbers[0] * 86400 - offset
         for item in list(history):
             ts = item.get("ts")
-            ok = item.get("ok", 0)
-            if ts is None or ts < start_day_ts:
+            if ts is None or ts < cutoff:
                 continue
-            dt = datetime.fromtimestamp(ts, tz=timezone.utc).date().isoformat()
-            if dt in counts:
-                counts[dt]["total"] += 1
-                counts[dt]["ok"] += int(ok)
+            day = (ts + offset) // 86400
+            ok, total = counts.get(day, (0, 0))
+            counts[day] = (ok + int(item.get("ok", 0)), total + 1)
 
     # create result array with percent (0-100)
-    for d in days_list:
-        key = d.isoformat()
-        total = counts[key]["total"]
-        ok = counts[key]["ok"]
+    result = []
+    for day in day_numbers:
+        ok, total = counts.get(day, (0, 0))
         pct = (ok/total)*100 if total>0 else None
+        key = datetime.fromtimestamp(day * 86400, tz=timezone.utc).date().isoformat()
         result.append({"date": key, "ok": ok, "total": total, "percent": pct})
     return result
 
 @app.route('/api/daily_status')
 def api_daily_status():
     """Return a visavail-style dataset for the last N days.
-       Query: ?days=90
+       Query: ?days=90&tz=8 (UTC offset in hours of the days, default STATUS_TZ_HOURS)
     """
-    from flask import request
-    days = int(request.args.get("days", 90))
-    agg = compute_daily_aggregates(days=days)
+    try:
+        days = min(max(int(request.args.get("days", 90)), 1), 366)
+        tz = float(request.args.get("tz", STATUS_TZ_HOURS))
+    except ValueError:
+        return make_response(jsonify({"error": "days must be an integer and tz a number"}), 400)
+    if not math.isfinite(tz):
+        return make_response(jsonify({"error": "tz must be a finite number"}), 400)
+    # Real UTC offsets are whole quarter hours; anything finer would only add cache keys
+    tz = min(max(round(tz * 4) / 4, -12), 14)
+    agg = compute_daily_aggregates(days=days, tz_offset_hours=tz)
 
     # map percent -> category key
     # categories: 'up' (green), 'degraded' (yellow), 'down' (red), 'no_data' (gray)
@@ -236,29 +342,128 @@ def api_daily_status():
     resp.headers['Access-Control-Allow-Origin'] = '*'
     return resp
 
-# Run in a separate thread
-import threading
-threading.Thread(target=lambda: app.run(host='0.0.0.0', port=7070), daemon=True).start()
+def start_status_page():
+    """Open the ping history and start the poller and the Flask server (port 7070) in threads.
 
-threading.Thread(target=poller, daemon=True).start()
+    Called when bot.py runs, not on import, so the parsers can be imported by tests and tools.
+    """
+    global db_conn
+    db_conn = init_db()
+    threading.Thread(target=poller, daemon=True).start()
+    threading.Thread(target=lambda: app.run(host='0.0.0.0', port=7070), daemon=True).start()
 
 TEMPLATES_DIR = Path(__file__).parent / "templates"
 HELP_TEXT = (TEMPLATES_DIR / "help.html").read_text(encoding="utf-8")
 
 load_dotenv()
-USER_BUSY = {}
 # Removed ACTIVE_OPERATIONS and cancellation logic
 
 # Configuration
-LOGIN_URL = "https://e2.partners/page/affiliate/login.jsp"
-DASHBOARD_URL = "https://e2.partners/page/affiliate/index.jsp"
+E2_BASE_URL = os.getenv("E2_BASE_URL", "https://e2.partners").rstrip("/")  # point at a local stand-in for testing
+LOGIN_URL = f"{E2_BASE_URL}/page/affiliate/login.jsp"
+DASHBOARD_URL = f"{E2_BASE_URL}/page/affiliate/index.jsp"
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CACHE_DURATION = 300  # 5 minutes cache
+REPORT_STALE_TTL = int(os.getenv("REPORT_STALE_TTL", 3600))  # older reports are still shown while refreshing, up to this age
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", 500))  # accounts kept in the report cache
+REPORT_STORE_TTL = int(os.getenv("REPORT_STORE_TTL", 6 * 3600))  # seconds a shown report stays navigable from memory
+REPORT_STORE_ACCOUNTS = int(os.getenv("REPORT_STORE_ACCOUNTS", 10))  # navigable accounts kept per user
+
+# Chrome driver pool
+DRIVER_POOL_SIZE = int(os.getenv("DRIVER_POOL_SIZE", 2))            # max live Chrome instances
+DRIVER_MAX_USES = int(os.getenv("DRIVER_MAX_USES", 50))             # recycle a driver after N checkouts
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", 800))        # recycle when chromedriver + Chrome exceed this
+DRIVER_CHECKOUT_TIMEOUT = int(os.getenv("DRIVER_CHECKOUT_TIMEOUT", 120))  # seconds to wait for a free driver
+
+# How scrape_single_currency() reads the page: "js" pulls everything in one
+# execute_script call, "html" parses driver.page_source in-process, "elements"
+# walks the DOM one WebDriver call at a time
+SCRAPE_BACKEND = os.getenv("SCRAPE_BACKEND", "js").lower()
+HTML_PARSE_WORKERS = int(os.getenv("HTML_PARSE_WORKERS", 2))
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")   # if set, save every captured page_source here (see check-parity)
+
+# "http" scrapes with plain requests first and falls back to Chrome when the
+# page isn't recognised; "browser" always uses Chrome
+SCRAPE_MODE = os.getenv("SCRAPE_MODE", "browser").lower()
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))        # keep-alive connections to e2.partners
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", 15))            # seconds per request
+HTTP_CURRENCY_PARAM = os.getenv("HTTP_CURRENCY_PARAM", "currency")  # index.jsp query param selecting a currency
+
+# Currencies of one account are scraped this many at a time, each in its own tab (1 = one by one).
+# Tabs share one server session, whose selected currency the site may keep per session rather
+# than per page, so only raise this after checking the account's figures stay per tab
+CURRENCY_FANOUT = int(os.getenv("CURRENCY_FANOUT", 1))
+
+CURRENCY_SWITCH_TIMEOUT = int(os.getenv("CURRENCY_SWITCH_TIMEOUT", 10))     # seconds to wait for a refresh
+CURRENCY_SWITCH_QUIET_MS = int(os.getenv("CURRENCY_SWITCH_QUIET_MS", 150))  # DOM/XHR silence that ends a refresh
+
+# Lazy currency mode: reply with the preferred currency only and scrape the others when navigated to
+LAZY_CURRENCIES = os.getenv("LAZY_CURRENCIES", "false").lower() in ("1","true","yes")
+WARM_SESSION_IDLE = int(os.getenv("WARM_SESSION_IDLE", 120))  # seconds a logged-in browser waits for the next currency
+
+# Blocking Chrome work runs on this thread pool, off the bot's event loop
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", DRIVER_POOL_SIZE))
+
+# Global scrape scheduler
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", DRIVER_POOL_SIZE))  # scrapes running at once, all users
+SCRAPE_MIN_FREE_MB = int(os.getenv("SCRAPE_MIN_FREE_MB", 400))  # only start another scrape above this free memory
+
+# Background prefetch (opt-in): pre-scrape accounts shortly before users usually fetch them
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() in ("1","true","yes")
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", 300))           # seconds between planning passes
+PREFETCH_LOOKBACK_DAYS = int(os.getenv("PREFETCH_LOOKBACK_DAYS", 7))    # accounts fetched within this window are "hot"
+PREFETCH_LEAD_MINUTES = int(os.getenv("PREFETCH_LEAD_MINUTES", 30))     # how early to scrape before a usual fetch hour
+PREFETCH_HOURS = os.getenv("PREFETCH_HOURS", "")                        # fixed MYT hours, e.g. "9,13,21"; empty = learn
+PREFETCH_MIN_HITS = int(os.getenv("PREFETCH_MIN_HITS", 2))              # fetches in an hour before it's learned
+PREFETCH_MAX_BROWSERS = int(os.getenv("PREFETCH_MAX_BROWSERS", 1))      # concurrent prefetch scrapes
+PREFETCH_JITTER = int(os.getenv("PREFETCH_JITTER", 90))                 # max random delay before each prefetch, seconds
+
+ACCOUNT_CACHE_TTL = int(os.getenv("ACCOUNT_CACHE_TTL", 600))  # seconds a user's affiliate_accounts rows are cached
+ACCOUNT_STORE = os.getenv("ACCOUNT_STORE", "supabase").lower()  # "supabase" or "sqlite"
+ACCOUNTS_DB = os.getenv("ACCOUNTS_DB", "accounts.db")           # SQLite file used when ACCOUNT_STORE=sqlite
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", 8))                # seconds per database call
+DB_RETRIES = int(os.getenv("DB_RETRIES", 3))                  # attempts per idempotent database call
+DB_RETRY_BACKOFF = float(os.getenv("DB_RETRY_BACKOFF", 0.5))  # first retry delay, doubled on each attempt
+
+# Report history: every scrape is kept in SQLite for trends and re-renders
+REPORT_DB = os.getenv("REPORT_DB", "reports.db")
+REPORT_RETENTION_DAYS = int(os.getenv("REPORT_RETENTION_DAYS", 90))   # history older than this is deleted
+REPORT_RAW_DAYS = int(os.getenv("REPORT_RAW_DAYS", 7))                # older history keeps one scrape per account/currency/day
+REPORT_PRUNE_INTERVAL = int(os.getenv("REPORT_PRUNE_INTERVAL", 3600)) # seconds between retention passes
+TREND_DAYS = int(os.getenv("TREND_DAYS", 7))                          # days listed in the trend view
+
+# Bot state (user_data and /addaff, /remove conversations) kept in SQLite across restarts
+PERSIST_STATE = os.getenv("PERSIST_STATE", "true").lower() in ("1","true","yes")
+STATE_DB = os.getenv("STATE_DB", "state.db")
+STATE_FLUSH_INTERVAL = int(os.getenv("STATE_FLUSH_INTERVAL", 30))   # seconds between writes of changed state
+USER_DATA_TTL_DAYS = int(os.getenv("USER_DATA_TTL_DAYS", 30))       # user_data untouched this long is dropped
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", 3600))         # seconds an unfinished conversation survives
+
+# Authenticated e2.partners sessions
+SESSION_TTL = int(os.getenv("SESSION_TTL", 1200))             # seconds a login's cookies are reused
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 500))  # max remembered logins
+
+# Outbound Telegram flood control
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))     # Bot API requests per second, all chats
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))          # messages per second to one private chat
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))          # short bursts allowed per private chat
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", 20 / 60))  # messages per second to one group
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 3))        # retries of a request after a RetryAfter
+
+# Incoming updates are handled this many at a time, one at a time per user (1 = fully sequential)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 16))
+
+# Webhook mode: receive updates on the :7070 server (POST /telegram/webhook) instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")          # public https URL proxied to /telegram/webhook; unset = polling
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")    # secret token Telegram echoes back; same on every replica
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() in ("1","true","yes")  # call setWebhook on startup
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # concurrent deliveries Telegram may open
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", 5))     # seconds to hand an update to the bot
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")  # point at a fake Bot API for testing
 
 # Supabase configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase_client = supabase.create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # Conversation states
 USERNAME, PASSWORD = range(2)
@@ -269,6 +474,142 @@ MYT = timezone(timedelta(hours=8))
 def get_malaysia_time():
     return datetime.now(MYT)
 
+scrape_executor = ThreadPoolExecutor(max_workers=SCRAPE_WORKERS, thread_name_prefix="scrape")
+
+async def run_blocking(executor, func, *args):
+    """Run a blocking call on `executor` so the event loop keeps serving other chats"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+class ScrapeJob:
+    """A queued call to a blocking scrape function; await `job.future` for its result"""
+
+    def __init__(self, user_id, func, args):
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.future = asyncio.get_running_loop().create_future()
+        self.submitted = time.monotonic()
+        self.position = 0   # place in the queue when submitted, 0 = started straight away
+        self.eta = 0        # rough seconds until the result is ready
+
+class ScrapeScheduler:
+    """Global scrape queue shared by every chat.
+
+    At most `max_running` jobs run at once. Waiting users are served round-robin,
+    so one user's fetch-all can't starve everybody else. Another job only starts
+    while the host has `min_free_mb` of memory available, unless nothing is running.
+    """
+
+    def __init__(self, max_running, min_free_mb, executor):
+        self.max_running = max(max_running, 1)
+        self.min_free_mb = min_free_mb
+        self.executor = executor
+        self._queues = {}        # user_id -> deque of waiting jobs
+        self._turns = deque()    # user ids with waiting jobs, in round-robin order
+        self._pending = {}       # user_id -> queued + running jobs
+        self._running = 0
+        self._avg_duration = 10.0  # moving average of job time, seeded with a typical scrape
+
+    def submit(self, user_id, func, *args) -> ScrapeJob:
+        job = ScrapeJob(user_id, func, args)
+        self._queues.setdefault(user_id, deque()).append(job)
+        if user_id not in self._turns:
+            self._turns.append(user_id)
+        self._pending[user_id] = self._pending.get(user_id, 0) + 1
+        self._dispatch()
+
+        job.position = self._position(job)
+        waves = -(-job.position // self.max_running)  # ceil: rounds of running jobs ahead of us
+        job.eta = round((waves + 1) * self._avg_duration)
+        return job
+
+    def is_busy(self, user_id) -> bool:
+        """True while the user has a job queued or running"""
+        return self._pending.get(user_id, 0) > 0
+
+    def stats(self):
+        return {
+            "running": self._running,
+            "queued": sum(len(q) for q in self._queues.values()),
+            "users_waiting": len(self._turns),
+            "avg_job_s": round(self._avg_duration, 1),
+        }
+
+    def _position(self, job):
+        """1-based position `job` will start at under round-robin, 0 if already started"""
+        if job.user_id not in self._queues or job not in self._queues[job.user_id]:
+            return 0
+        queues = {uid: list(q) for uid, q in self._queues.items()}
+        turns = deque(self._turns)
+        position = 0
+        while turns:
+            uid = turns.popleft()
+            position += 1
+            if queues[uid].pop(0) is job:
+                return position
+            if queues[uid]:
+                turns.append(uid)
+        return position
+
+    def _memory_ok(self):
+        available_mb = psutil.virtual_memory().available / (1024 * 1024)
+        return available_mb >= self.min_free_mb
+
+    def _dispatch(self):
+        while self._turns and self._running < self.max_running:
+            if self._running > 0 and not self._memory_ok():
+                # Retried whenever a running job finishes
+                metrics.incr("scheduler.memory_deferrals")
+                break
+            user_id = self._turns.popleft()
+            queue = self._queues[user_id]
+            job = queue.popleft()
+            if queue:
+                self._turns.append(user_id)
+            else:
+                del self._queues[user_id]
+            self._running += 1
+            asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job):
+        start = time.monotonic()
+        metrics.observe("scheduler.queue_wait", start - job.submitted)
+        try:
+            result = await run_blocking(self.executor, job.func, *job.args)
+            if not job.future.done():
+                job.future.set_result(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        finally:
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * (time.monotonic() - start)
+            self._running -= 1
+            self._pending[job.user_id] -= 1
+            if not self._pending[job.user_id]:
+                del self._pending[job.user_id]
+            self._dispatch()
+
+scheduler = ScrapeScheduler(SCRAPE_CONCURRENCY, SCRAPE_MIN_FREE_MB, scrape_executor)
+metrics.register_gauge("scheduler", scheduler.stats)
+
+def queue_note(job) -> str:
+    """Queue position suffix for status messages, empty when the job started immediately"""
+    if not job.position:
+        return ""
+    return f" You are #{job.position} in the queue (ETA≈ {job.eta}s)"
+
+_chromedriver_path = None
+_chromedriver_lock = threading.Lock()
+
+def get_chromedriver_path():
+    """Resolve the chromedriver binary once instead of on every driver launch"""
+    global _chromedriver_path
+    with _chromedriver_lock:
+        if _chromedriver_path is None:
+            _chromedriver_path = ChromeDriverManager().install()
+        return _chromedriver_path
+
 def create_driver():
     try:
         
@@ -291,7 +632,7 @@ def create_driver():
         chrome_options.add_argument("--allow-running-insecure-content")
         chrome_options.add_argument("--disable-features=IsolateOrigins,site-per-process")
         
-        service = Service(ChromeDriverManager().install())
+        service = Service(get_chromedriver_path())
         driver  = webdriver.Chrome(service=service, options=chrome_options)
 
         return driver
@@ -300,49 +641,352 @@ def create_driver():
         logger.error(f"Driver creation failed: {e}")
         return None
 
+class DriverPool:
+    """Bounded pool of warm Chrome drivers shared by all scrapes.
+
+    Drivers are reset (cookies, storage, extra windows) when checked back in and
+    retired after `max_uses` checkouts or once their process tree exceeds
+    `max_rss_mb`, so a long-running bot doesn't accumulate leaky Chromes.
+    """
+
+    def __init__(self, size, max_uses, max_rss_mb):
+        self.size = max(size, 1)
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self._idle = []   # warm drivers ready for checkout
+        self._uses = {}   # id(driver) -> number of completed checkouts
+        self._live = 0    # idle + checked out
+        self._cond = threading.Condition()
+        self.reclaim = None  # callable that hands a driver held elsewhere back to the pool; False if none
+
+    def checkout(self, timeout=DRIVER_CHECKOUT_TIMEOUT):
+        """Borrow a driver, launching one if the pool isn't full; None on timeout/failure"""
+        start = time.monotonic()
+        deadline = start + timeout
+        driver = None
+        if self.reclaim is not None and not self._idle and self._live >= self.size:
+            self.reclaim()
+        with self._cond:
+            while True:
+                if self._idle:
+                    driver = self._idle.pop()
+                    break
+                if self._live < self.size:
+                    self._live += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.incr("driver_pool.timeouts")
+                    logger.error("Timed out waiting for a free Chrome driver")
+                    return None
+                self._cond.wait(remaining)
+        metrics.observe("driver_pool.wait", time.monotonic() - start)
+
+        if driver is not None:
+            if self._healthy(driver):
+                metrics.incr("driver_pool.hits")
+                return driver
+            logger.warning("Discarding unhealthy pooled driver")
+            self._quit(driver)
+
+        metrics.incr("driver_pool.misses")
+        driver = create_driver()
+        if driver is None:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+        return driver
+
+    def checkin(self, driver, broken=False):
+        """Return a driver to the pool, or retire it if it is broken or worn out"""
+        uses = self._uses.get(id(driver), 0) + 1
+        self._uses[id(driver)] = uses
+        retire = broken or uses >= self.max_uses
+        if not retire and self.max_rss_mb:
+            rss = self._rss_mb(driver)
+            if rss > self.max_rss_mb:
+                logger.info(f"Recycling driver using {rss:.0f}MB after {uses} uses")
+                retire = True
+        if not retire and not self._reset(driver):
+            retire = True
+
+        if retire:
+            metrics.incr("driver_pool.recycled")
+            self._quit(driver)
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+        else:
+            with self._cond:
+                self._idle.append(driver)
+                self._cond.notify()
+
+    @contextmanager
+    def driver(self):
+        """`with driver_pool.driver() as driver:` - yields None if no driver could be obtained"""
+        driver = self.checkout()
+        broken = False
+        try:
+            yield driver
+        except Exception:
+            broken = True
+            raise
+        finally:
+            if driver is not None:
+                self.checkin(driver, broken=broken)
+
+    def stats(self):
+        hits = metrics.get("driver_pool.hits")
+        checkouts = hits + metrics.get("driver_pool.misses")
+        with self._cond:
+            return {
+                "size": self.size,
+                "live": self._live,
+                "idle": len(self._idle),
+                "hit_rate": round(hits / checkouts, 3) if checkouts else None,
+            }
+
+    def close(self):
+        """Quit all idle drivers (called at interpreter exit)"""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._live -= len(idle)
+        for driver in idle:
+            self._quit(driver)
+
+    def _healthy(self, driver):
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def _reset(self, driver):
+        """Leave the driver as a fresh browser: one blank window, no cookies or storage"""
+        try:
+            handles = driver.window_handles
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+            try:
+                driver.execute_script("window.localStorage.clear(); window.sessionStorage.clear();")
+            except Exception:
+                pass  # about:blank and friends have no storage
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            driver.get("about:blank")
+            return True
+        except Exception as e:
+            logger.warning(f"Driver reset failed: {e}")
+            return False
+
+    def _rss_mb(self, driver):
+        try:
+            proc = psutil.Process(driver.service.process.pid)
+            procs = [proc] + proc.children(recursive=True)
+            return sum(p.memory_info().rss for p in procs) / (1024 * 1024)
+        except Exception:
+            return 0
+
+    def _quit(self, driver):
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.warning(f"Driver quit failed: {e}")
+
+driver_pool = DriverPool(DRIVER_POOL_SIZE, DRIVER_MAX_USES, DRIVER_MAX_RSS_MB)
+metrics.register_gauge("driver_pool", driver_pool.stats)
+atexit.register(driver_pool.close)
+
     
-def validate_credentials(username: str, password: str) -> bool:
-    """Validate affiliate credentials by attempting login and return available currencies"""
-    driver = create_driver()
-    if not driver:
-        return False
-    
+class SessionStore:
+    """Post-login cookies per (user_id, username) so repeat fetches can skip login.jsp"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()  # (user_id, username) -> (saved_at, cookies)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, username):
+        key = (user_id, username)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                return None
+            saved_at, cookies = entry
+            if time.time() - saved_at > self.ttl:
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return cookies
+
+    def put(self, user_id, username, cookies):
+        if not cookies:
+            return
+        with self._lock:
+            self._sessions[(user_id, username)] = (time.time(), cookies)
+            self._sessions.move_to_end((user_id, username))
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def invalidate(self, user_id, username):
+        with self._lock:
+            self._sessions.pop((user_id, username), None)
+
+    def share(self, from_user, to_user, username):
+        """Copy one user's session of `username` to another user who logged in with the same password"""
+        with self._lock:
+            entry = self._sessions.get((from_user, username))
+            if entry is not None:
+                self._sessions[(to_user, username)] = entry
+                self._sessions.move_to_end((to_user, username))
+                while len(self._sessions) > self.max_size:
+                    self._sessions.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "ttl": self.ttl}
+
+session_store = SessionStore(SESSION_TTL, SESSION_CACHE_SIZE)
+metrics.register_gauge("session_store", session_store.stats)
+
+def login(driver, username: str, password: str):
+    """Run the login.jsp form flow; raises if the dashboard never loads"""
+    driver.delete_all_cookies()
+    driver.get(LOGIN_URL)
+    WebDriverWait(driver, 15).until(
+        lambda d: d.execute_script("return document.readyState") == "complete"
+    )
+
+    # Fill credentials
+    username_field = WebDriverWait(driver, 15).until(
+        EC.presence_of_element_located((By.NAME, "userId"))
+    )
+    username_field.send_keys(username)
+
+    password_field = WebDriverWait(driver, 15).until(
+        EC.presence_of_element_located((By.NAME, "password"))
+    )
+    password_field.send_keys(password)
+
+    # Click login button
+    login_button = WebDriverWait(driver, 15).until(
+        EC.element_to_be_clickable((By.ID, "login"))
+    )
+    login_button.click()
+
+    # Wait for dashboard
+    WebDriverWait(driver, 20).until(
+        EC.url_contains("index.jsp")
+    )
+
+def restore_session(driver, cookies) -> bool:
+    """Inject saved cookies and check that DASHBOARD_URL loads without bouncing to login.jsp"""
     try:
-        driver.get(LOGIN_URL)
-        
-        
-        # Fill credentials
-        username_field = WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.NAME, "userId"))
-        )
-        username_field.send_keys(username)
-        
-        password_field = WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.NAME, "password"))
-        )
-        password_field.send_keys(password)
-        
-        # Click login button
-        login_button = WebDriverWait(driver, 15).until(
-            EC.element_to_be_clickable((By.ID, "login"))
-        )
-        login_button.click()
-        
-        # Check if login was successful
-        WebDriverWait(driver, 15).until(
-            EC.url_contains("index.jsp")
-        )
-        
-        # Get available currencies
-        currency_options = get_available_currencies(driver)
-        logger.info(f"Found {len(currency_options)} currencies for {username}")
-        
-        return True
+        for cookie in cookies:
+            params = {k: cookie[k] for k in ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite") if k in cookie}
+            if "expiry" in cookie:
+                params["expires"] = cookie["expiry"]
+            driver.execute_cdp_cmd("Network.setCookie", params)
+
+        driver.get(DASHBOARD_URL)
+        WebDriverWait(driver, 20).until(EC.any_of(
+            EC.url_contains("login.jsp"),
+            EC.presence_of_element_located((By.CLASS_NAME, "panel"))
+        ))
+        return "index.jsp" in driver.current_url
     except Exception as e:
-        logger.error(f"Validation failed: {str(e)}")
+        logger.warning(f"Session restore failed: {str(e)}")
         return False
-    finally:
-        driver.quit()
+
+def open_dashboard(driver, username: str, password: str, user_id: int):
+    """Get `driver` onto the dashboard, reusing a cached session when one is still valid"""
+    cookies = session_store.get(user_id, username)
+    if cookies and restore_session(driver, cookies):
+        metrics.incr("session_cache.hits")
+        logger.info(f"Reused session for {username}")
+        return
+
+    if cookies:
+        metrics.incr("session_cache.expired")
+        session_store.invalidate(user_id, username)
+    else:
+        metrics.incr("session_cache.misses")
+
+    login(driver, username, password)
+    session_store.put(user_id, username, driver.get_cookies())
+
+class SingleFlight:
+    """Collapse concurrent identical calls: later callers wait for the first call's result"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}   # key -> in-flight call state
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            metrics.incr(f"singleflight.{self.name}.saved")
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func(*args)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+scrape_flights = SingleFlight("scrape")
+validate_flights = SingleFlight("validate")
+metrics.register_gauge("singleflight", lambda: {
+    "scrapes_in_flight": scrape_flights.in_flight(),
+    "validations_in_flight": validate_flights.in_flight(),
+})
+
+def login_key(username: str, password: str):
+    """Single-flight key for one affiliate login (the password is hashed, never kept as-is)"""
+    return (username, hashlib.sha256(password.encode("utf-8")).hexdigest())
+
+def validate_credentials(username: str, password: str) -> bool:
+    """Validate affiliate credentials; concurrent checks of the same login share one browser"""
+    return validate_flights.do(login_key(username, password), _validate_credentials, username, password)
+
+def _validate_credentials(username: str, password: str) -> bool:
+    """Validate affiliate credentials by attempting login and return available currencies"""
+    with driver_pool.driver() as driver:
+        if not driver:
+            return False
+
+        try:
+            # Check if login was successful
+            login(driver, username, password)
+            
+            # Get available currencies
+            currency_options = get_available_currencies(driver)
+            logger.info(f"Found {len(currency_options)} currencies for {username}")
+            
+            return True
+        except Exception as e:
+            logger.error(f"Validation failed: {str(e)}")
+            return False
 
 def get_available_currencies(driver):
     """Get available currencies from dropdown"""
@@ -368,554 +1012,2768 @@ def get_available_currencies(driver):
         logger.error(f"Error getting currencies: {str(e)}")
         return []
 
+# Installed before a currency switch: counts DOM mutations and in-flight XHR/fetch calls
+# and remembers the commission text, so we can tell when the dashboard has re-rendered
+ARM_REFRESH_WATCH_JS = """
+const w = window;
+const commission = document.getElementById('thisPeriodCommission');
+w.__e2Refresh = {mutations: 0, requests: 0, lastActivity: Date.now(),
+                 commission: commission ? commission.textContent : null};
+if (!w.__e2Hooked) {
+    w.__e2Hooked = true;
+    w.__e2Pending = 0;
+    const activity = () => { if (w.__e2Refresh) w.__e2Refresh.lastActivity = Date.now(); };
+    const started = () => { w.__e2Pending++; if (w.__e2Refresh) w.__e2Refresh.requests++; activity(); };
+    const finished = () => { w.__e2Pending = Math.max(0, w.__e2Pending - 1); activity(); };
+    const send = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function () {
+        started();
+        this.addEventListener('loadend', finished);
+        return send.apply(this, arguments);
+    };
+    if (w.fetch) {
+        const fetch = w.fetch;
+        w.fetch = function () { started(); return fetch.apply(this, arguments).finally(finished); };
+    }
+    new MutationObserver(() => {
+        if (w.__e2Refresh) { w.__e2Refresh.mutations++; activity(); }
+    }).observe(document.body, {childList: true, subtree: true, characterData: true});
+}
+"""
+
+# True once the refresh started by a switch has finished: either the page reloaded (our
+# state is gone) and is complete, or requests/mutations happened and have gone quiet
+REFRESH_DONE_JS = """
+const quietMs = arguments[0];
+const s = window.__e2Refresh;
+const commission = document.getElementById('thisPeriodCommission');
+if (!s) return document.readyState === 'complete' && !!commission;
+if (window.__e2Pending > 0) return false;
+const changed = !!commission && commission.textContent !== s.commission;
+const active = changed || s.mutations > 0 || s.requests > 0;
+return active && Date.now() - s.lastActivity >= quietMs;
+"""
+
+def start_currency_switch(driver, currency_value):
+    """Pick a currency in the dropdown without waiting for the dashboard to refresh.
+
+    Returns False when the currency was already selected (nothing will refresh).
+    """
+    # Wait for currency dropdown to be present
+    currency_dropdown = WebDriverWait(driver, 10).until(
+        EC.presence_of_element_located((By.ID, "dashboardCurrency"))
+    )
+
+    if selected_currency(driver) == currency_value:
+        return False
+    driver.execute_script(ARM_REFRESH_WATCH_JS)
+    select = Select(currency_dropdown)
+    select.select_by_value(currency_value)
+    return True
+
+def wait_for_refresh(driver, label) -> bool:
+    """Block until the dashboard has re-rendered after start_currency_switch().
+
+    False on timeout: the page may still show the previous currency's figures.
+    """
+    start = time.monotonic()
+    try:
+        WebDriverWait(driver, CURRENCY_SWITCH_TIMEOUT, poll_frequency=0.1).until(
+            lambda d: d.execute_script(REFRESH_DONE_JS, CURRENCY_SWITCH_QUIET_MS)
+        )
+    except TimeoutException:
+        metrics.incr("currency_switch.timeouts")
+        logger.warning(f"No dashboard refresh seen after switching to {label}")
+        return False
+    elapsed = time.monotonic() - start
+    metrics.observe("currency_switch", elapsed)
+    logger.info(f"Currency switch to {label} took {elapsed * 1000:.0f}ms")
+    return True
+
+def selected_currency(driver):
+    """Value currently selected in the dashboardCurrency dropdown"""
+    return driver.execute_script(
+        "const el = document.getElementById('dashboardCurrency'); return el ? el.value : null;"
+    )
+
 def change_currency(driver, currency_value):
     """Change dashboard currency"""
     try:
-        # Wait for currency dropdown to be present
-        currency_dropdown = WebDriverWait(driver, 10).until(
-            EC.presence_of_element_located((By.ID, "dashboardCurrency"))
-        )
-        
-        select = Select(currency_dropdown)
-        select.select_by_value(currency_value)
-        
-        # Wait for page to update - we'll wait for commission elements to update
+        if start_currency_switch(driver, currency_value):
+            # Wait for the dashboard to finish re-rendering with the new currency
+            return wait_for_refresh(driver, currency_value)
+        return True
+    except Exception as e:
+        logger.error(f"Error changing currency to {currency_value}: {str(e)}")
+        return False
+
+CURRENCY_SYMBOLS = '$€£¥₩₹₽₿₺₴₸₲₵₡₪₫'
+
+# Dashboard sections: panel title plus a positional CSS fallback
+SECTION_SELECTORS = {
+    "Registered Users": {
+        "title": "Registered Users",
+        "container": "div:nth-child(5)"  # Adjust based on screenshot
+    },
+    "First Deposit": {
+        "title": "First Deposit",
+        "container": "div:nth-child(3) > div:nth-child(3)"  # Adjust based on screenshot
+    },
+    "Deposit": {
+        "title": "Deposit",
+        "container": "div:nth-child(4) > div:nth-child(1)"  # Adjust based on screenshot
+    },
+    "Withdrawal": {
+        "title": "Withdrawal",
+        "container": "div:nth-child(4) > div:nth-child(2)"  # Adjust based on screenshot
+    },
+    "Affiliate Profit & Loss": {
+        "title": "Affiliate Profit & Loss",
+        "container": "div:nth-child(7)"  # Adjust based on screenshot
+    },
+    "Turnover": {
+        "title": "Turnover",
+        "container": "div:nth-child(6) > div:nth-child(2)"  # Adjust based on screenshot
+    }
+}
+
+RED_SPAN_XPATH = ".//span[contains(@style, 'color:red') or contains(@style, 'color: red')]"
+
+# A dashboard "snapshot" is the raw text pulled off the page, independent of how it was read:
+#   {"active_players": {"this_period", "last_period"} | None,
+#    "commissions":    {"this_period", "last_period"} | None,
+#    "withdrawable":   {"symbol", "amount"} | None,
+#    "sections":       {name: {"headers": [...], "rows": [[{"text", "red"}, ...], ...]}}}
+# where section rows skip the header <tr> and "red" is the text of the first red <span>
+# in the cell (None when there is none). build_currency_report() turns it into a CurrencyReport.
+
+EXTRACT_DASHBOARD_JS = """
+const selectors = arguments[0];
+const redXpath = arguments[1];
+const text = el => el ? (el.innerText || el.textContent || '').trim() : '';
+const first = (expr, ctx) => document.evaluate(
+    expr, ctx || document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+const byId = id => document.getElementById(id);
+
+const out = {active_players: null, commissions: null, withdrawable: null, sections: {}};
+
+const thisPlayers = byId('thisPeriodActivePlayer'), lastPlayers = byId('lastPeriodActivePlayer');
+if (thisPlayers && lastPlayers) {
+    out.active_players = {this_period: text(thisPlayers), last_period: text(lastPlayers)};
+}
+const thisComm = byId('thisPeriodCommission'), lastComm = byId('lastPeriodCommission');
+if (thisComm && lastComm) {
+    out.commissions = {this_period: text(thisComm), last_period: text(lastComm)};
+}
+const userInfo = document.getElementsByClassName('user-info')[0];
+const money = userInfo && userInfo.getElementsByClassName('money')[0];
+const symbol = money && money.querySelector('#navBarMoney');
+const amount = money && money.querySelector('#navBarAvailable');
+if (symbol && amount) {
+    out.withdrawable = {symbol: text(symbol), amount: text(amount)};
+}
+
+for (const [name, sel] of Object.entries(selectors)) {
+    let section = first("//h2[normalize-space()='" + sel.title + "']/ancestor::div[contains(@class, 'panel')]");
+    if (!section) {
+        try { section = document.querySelector('div.panel > ' + sel.container); } catch (e) {}
+    }
+    if (!section) {
+        for (const panel of document.getElementsByClassName('panel')) {
+            if (text(panel).includes(sel.title)) { section = panel; break; }
+        }
+    }
+    const table = section && section.querySelector('table');
+    if (!table) continue;
+    out.sections[name] = {
+        headers: Array.from(table.querySelectorAll('th'), th => text(th)),
+        rows: Array.from(table.querySelectorAll('tr')).slice(1).map(tr =>
+            Array.from(tr.querySelectorAll('td'), td => {
+                const red = first(redXpath, td);
+                return {text: text(td), red: red ? text(red) : null};
+            })),
+    };
+}
+return out;
+"""
+
+def snapshot_dashboard_js(driver):
+    """Read the whole dashboard in a single execute_script round-trip; None if the page isn't usable"""
+    try:
         WebDriverWait(driver, 10).until(
             EC.presence_of_element_located((By.ID, "thisPeriodCommission"))
         )
-        
-        # Additional wait to ensure data has refreshed
-        time.sleep(1)
+        snapshot = driver.execute_script(EXTRACT_DASHBOARD_JS, SECTION_SELECTORS, RED_SPAN_XPATH)
+    except Exception as e:
+        logger.warning(f"JS extraction failed, falling back to element scraping: {str(e)}")
+        return None
+
+    return check_snapshot(snapshot, "JS extraction")
+
+def check_snapshot(snapshot, source):
+    """Return `snapshot` if it looks like a dashboard page, else None so callers can fall back"""
+    if not isinstance(snapshot, dict) or not snapshot.get("commissions") or not snapshot.get("sections"):
+        logger.warning(f"{source} returned an incomplete page, falling back to element scraping")
+        return None
+
+    missing = [name for name in SECTION_SELECTORS if name not in snapshot["sections"]]
+    if missing:
+        logger.warning(f"Sections not found: {', '.join(missing)}")
+    if not snapshot.get("active_players"):
+        logger.warning("Could not scrape active players")
+    if not snapshot.get("withdrawable"):
+        logger.warning("Could not scrape withdrawable amount")
+    return snapshot
+
+html_parse_executor = ThreadPoolExecutor(max_workers=HTML_PARSE_WORKERS, thread_name_prefix="html-parse")
+
+def capture_page_source(driver, label="page"):
+    """Grab the rendered dashboard HTML once, optionally saving it to SNAPSHOT_DIR as a fixture"""
+    WebDriverWait(driver, 10).until(
+        EC.presence_of_element_located((By.ID, "thisPeriodCommission"))
+    )
+    html = driver.page_source
+    if SNAPSHOT_DIR:
+        try:
+            safe_label = re.sub(r"[^A-Za-z0-9_-]+", "_", label)
+            path = Path(SNAPSHOT_DIR) / f"{int(time.time() * 1000)}_{safe_label}.html"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(html, encoding="utf-8")
+        except Exception as e:
+            logger.warning(f"Could not save page snapshot: {e}")
+    return html
+
+def _container_xpath(container):
+    """Translate a SECTION_SELECTORS "div:nth-child(3) > div:nth-child(3)" chain into XPath steps"""
+    steps = []
+    for part in container.split(">"):
+        tag, index = re.fullmatch(r"\s*(\w+):nth-child\((\d+)\)\s*", part).groups()
+        steps.append(f"/*[{index}][self::{tag}]")
+    return "".join(steps)
+
+def snapshot_dashboard_html(html):
+    """Parse dashboard HTML (e.g. driver.page_source) into a snapshot without touching the browser.
+
+    Lookups mirror EXTRACT_DASHBOARD_JS so both backends agree on the same page.
+    Returns None when the page doesn't look like a dashboard.
+    """
+    try:
+        root = lxml.html.fromstring(html)
+    except Exception as e:
+        logger.warning(f"Could not parse dashboard HTML: {e}")
+        return None
+
+    def text(el):
+        return " ".join(el.text_content().split()) if el is not None else ""
+
+    def first(expr, ctx=root, **variables):
+        found = ctx.xpath(expr, **variables)
+        return found[0] if found else None
+
+    def by_id(element_id):
+        return first("//*[@id=$id]", id=element_id)
+
+    has_class = "contains(concat(' ', normalize-space(@class), ' '), concat(' ', $cls, ' '))"
+    snapshot = {"active_players": None, "commissions": None, "withdrawable": None, "sections": {}}
+
+    this_players, last_players = by_id("thisPeriodActivePlayer"), by_id("lastPeriodActivePlayer")
+    if this_players is not None and last_players is not None:
+        snapshot["active_players"] = {"this_period": text(this_players), "last_period": text(last_players)}
+
+    this_comm, last_comm = by_id("thisPeriodCommission"), by_id("lastPeriodCommission")
+    if this_comm is not None and last_comm is not None:
+        snapshot["commissions"] = {"this_period": text(this_comm), "last_period": text(last_comm)}
+
+    user_info = first(f"//*[{has_class}]", cls="user-info")
+    money = first(f".//*[{has_class}]", user_info, cls="money") if user_info is not None else None
+    if money is not None:
+        symbol = first(".//*[@id='navBarMoney']", money)
+        amount = first(".//*[@id='navBarAvailable']", money)
+        if symbol is not None and amount is not None:
+            snapshot["withdrawable"] = {"symbol": text(symbol), "amount": text(amount)}
+
+    panels = root.xpath(f"//*[{has_class}]", cls="panel")
+    for section_name, selector in SECTION_SELECTORS.items():
+        section = first(
+            "//h2[normalize-space()=$title]/ancestor::div[contains(@class, 'panel')]",
+            title=selector["title"]
+        )
+        if section is None:
+            section = first(
+                f"//div[{has_class}]" + _container_xpath(selector["container"]), cls="panel"
+            )
+        if section is None:
+            section = next((p for p in panels if selector["title"] in text(p)), None)
+        table = first(".//table", section) if section is not None else None
+        if table is None:
+            continue
+
+        rows = []
+        for tr in table.xpath(".//tr")[1:]:
+            row = []
+            for td in tr.xpath(".//td"):
+                red = first(RED_SPAN_XPATH, td)
+                row.append({"text": text(td), "red": text(red) if red is not None else None})
+            rows.append(row)
+        snapshot["sections"][section_name] = {
+            "headers": [text(th) for th in table.xpath(".//th")],
+            "rows": rows
+        }
+
+    return check_snapshot(snapshot, "HTML parser")
+
+def check_parity(backend, report, reference) -> bool:
+    """Log where a fast backend's report disagrees with the element-by-element reference"""
+    if report == reference:
         return True
+    differing = [f.name for f in fields(CurrencyReport) if getattr(report, f.name) != getattr(reference, f.name)]
+    logger.warning(f"{backend} backend disagrees with element scraping on: {', '.join(sorted(differing))}")
+    return False
+
+def check_snapshot_parity(directory) -> int:
+    """Parse every saved page in `directory` with both the HTML parser and element scraping.
+
+    Offline counterpart of SNAPSHOT_DIR: each fixture is opened in a pooled Chrome
+    (file://) for snapshot_dashboard_elements(). Returns the number of mismatches.
+    """
+    if not directory:
+        raise ValueError("No snapshot directory: pass one or set SNAPSHOT_DIR")
+    paths = sorted(Path(directory).glob("*.html"))
+    mismatches = 0
+    with driver_pool.driver() as driver:
+        if not driver:
+            raise RuntimeError("No Chrome driver available for the parity check")
+        for path in paths:
+            html = path.read_text(encoding="utf-8")
+            snapshot = snapshot_dashboard_html(html)
+            driver.get(path.resolve().as_uri())
+            reference = build_currency_report(snapshot_dashboard_elements(driver))
+            if snapshot is None:
+                logger.warning(f"{path.name}: HTML parser did not recognise the page")
+                mismatches += 1
+            elif not check_parity(f"html ({path.name})", build_currency_report(snapshot), reference):
+                mismatches += 1
+    logger.info(f"Parity check: {len(paths) - mismatches}/{len(paths)} snapshots match")
+    return mismatches
+
+def snapshot_dashboard_elements(driver):
+    """Read the dashboard element by element (one WebDriver call per lookup); slow but tolerant"""
+    snapshot = {"active_players": None, "commissions": None, "withdrawable": None, "sections": {}}
+
+    # Step 3: Scrape Active Players
+    try:
+        this_period = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, "thisPeriodActivePlayer"))
+        ).text
+        last_period = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, "lastPeriodActivePlayer"))
+        ).text
+        snapshot["active_players"] = {
+            "this_period": this_period,
+            "last_period": last_period
+        }
     except Exception as e:
-        logger.error(f"Error changing currency to {currency_value}: {str(e)}")
-        return False
+        logger.warning(f"Could not scrape active players: {str(e)}")
+
+    try:
+        this_period_commission = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, "thisPeriodCommission"))
+        ).text
+        last_period_commission = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, "lastPeriodCommission"))
+        ).text
+        snapshot["commissions"] = {
+            "this_period": this_period_commission,
+            "last_period": last_period_commission
+        }
+    except Exception as e:
+        logger.warning(f"Could not scrape commissions: {str(e)}")
+
+    # New: Scrape Withdrawable Amount
+    try:
+        # Wait for user info element
+        user_info = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.CLASS_NAME, "user-info"))
+        )
+
+        # Extract money elements
+        money_element = user_info.find_element(By.CLASS_NAME, "money")
+        snapshot["withdrawable"] = {
+            "symbol": money_element.find_element(By.ID, "navBarMoney").text.strip(),
+            "amount": money_element.find_element(By.ID, "navBarAvailable").text.strip()
+        }
+    except Exception as e:
+        logger.warning(f"Could not scrape withdrawable amount: {str(e)}")
+
+    # Step 4: Scrape sections using multiple identification methods
+    for section_name, selector in SECTION_SELECTORS.items():
+        try:
+            # Try multiple methods to find the section
+            section = None
+
+            # Method 1: By exact title text
+            try:
+                section = driver.find_element(
+                    By.XPATH,
+                    f"//h2[normalize-space()='{selector['title']}']/ancestor::div[contains(@class, 'panel')]"
+                )
+            except NoSuchElementException:
+                pass
+
+            # Method 2: By container position (CSS selector)
+            if not section:
+                try:
+                    section = driver.find_element(
+                        By.CSS_SELECTOR,
+                        f"div.panel > {selector['container']}"
+                    )
+                except NoSuchElementException:
+                    pass
+
+            # Method 3: Fallback to general panel search
+            if not section:
+                panels = driver.find_elements(By.CLASS_NAME, "panel")
+                for panel in panels:
+                    if selector['title'] in panel.text:
+                        section = panel
+                        break
+
+            if not section:
+                logger.warning(f"Section not found: {section_name}")
+                continue
+
+            # Extract table data
+            table = section.find_element(By.TAG_NAME, "table")
+            headers = [th.text.strip() for th in table.find_elements(By.TAG_NAME, "th")]
+
+            # Pull every row; only the period/count/amount columns are ever used
+            rows = []
+            for tr in table.find_elements(By.TAG_NAME, "tr")[1:]:
+                row = []
+                for i, td in enumerate(tr.find_elements(By.TAG_NAME, "td")):
+                    if i > 2:
+                        row.append({"text": "", "red": None})
+                        continue
+                    red = None
+                    # Red spans only matter for Profit & Loss amounts
+                    if section_name == "Affiliate Profit & Loss" and i == 2:
+                        red_spans = td.find_elements(By.XPATH, RED_SPAN_XPATH)
+                        if red_spans:
+                            red = red_spans[0].text.strip()
+                    row.append({"text": td.text.strip(), "red": red})
+                rows.append(row)
+
+            snapshot["sections"][section_name] = {"headers": headers, "rows": rows}
+
+        except Exception as e:
+            logger.error(f"Error processing section {section_name}: {str(e)}")
+            continue
+
+    return snapshot
+
+# Report model: build_currency_report() reads a snapshot once, at scrape time, into the
+# text each value is shown with. Messages are rendered from that text; the numbers are
+# parsed from it only where they're needed (history and trends).
+NUMBER_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+
+@dataclass(slots=True)
+class Money:
+    """An amount and the currency symbol the dashboard shows with it"""
+    amount: Decimal
+    symbol: str = ""
+
+@dataclass(slots=True)
+class ReportRow:
+    """One period of a dashboard section as shown (Registered Users rows have no amount)"""
+    period: str
+    count_text: str
+    amount_text: str | None = None
+
+    @property
+    def count(self):
+        return parse_count(self.count_text)
+
+    @property
+    def amount(self):
+        money = parse_money(self.amount_text)
+        return money.amount if money else None
+
+@dataclass(slots=True)
+class CurrencyReport:
+    """One currency of an account's dashboard, each value as the message shows it"""
+    active_this: str | None = None
+    active_last: str | None = None
+    commission_this: str | None = None
+    commission_last: str | None = None
+    withdrawable_symbol: str | None = None
+    withdrawable: str | None = None
+    sections: dict = field(default_factory=dict)  # section name -> [ReportRow, ...]
+
+    def to_dict(self):
+        """JSON-safe form for the report history"""
+        return {
+            "active": [self.active_this, self.active_last],
+            "commissions": [self.commission_this, self.commission_last],
+            "withdrawable": [self.withdrawable_symbol, self.withdrawable],
+            "sections": {
+                name: [[r.period, r.count_text, r.amount_text] for r in rows]
+                for name, rows in self.sections.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            *data["active"],
+            *data["commissions"],
+            *data["withdrawable"],
+            sections={name: [ReportRow(*row) for row in rows] for name, rows in data["sections"].items()},
+        )
+
+def parse_money(text):
+    """Money for dashboard text such as "$1,234.50", "-€12" or "-$ 1,000"; None without a number"""
+    if not text:
+        return None
+    match = NUMBER_RE.search(text)
+    if not match:
+        return None
+    prefix = text[:match.start()]
+    amount = Decimal(match.group().replace(",", ""))
+    if "-" in prefix:
+        amount = -amount
+    symbol = prefix.replace("-", "").strip() or text[match.end():].strip()
+    return Money(amount, symbol)
+
+def parse_count(text):
+    """Integer in dashboard text such as "1,234"; None without a number"""
+    match = NUMBER_RE.search(text or "")
+    return int(match.group().split(".")[0].replace(",", "")) if match else None
+
+def build_currency_report(snapshot):
+    """Turn a dashboard snapshot into the CurrencyReport consumed by format_report()"""
+    # Commissions are shown with one space between the symbol and the amount
+    def spaced(text):
+        clean = text.strip()
+        if clean and not clean[0].isdigit():
+            for i, char in enumerate(clean):
+                if char.isdigit() or char in '.,-':
+                    return f"{clean[:i].strip()} {clean[i:].strip()}"
+        return text
+
+    # Profit & Loss marks losses with a red span; those amounts are negative, without spaces
+    def signed_text(cell):
+        red = cell.get("red")
+        if red is None:
+            return cell["text"].replace(" ", "")
+        return (red if not red or red.startswith('-') else '-' + red).replace(" ", "")
+
+    # Section amounts: a leading currency symbol is split off (after the minus sign of a
+    # negative amount); rows without one use the commissions' symbol. Profit & Loss is
+    # shown without a symbol.
+    def shown_amount(text, section_symbol, profit_loss):
+        symbol = ''
+        if text.startswith('-') and len(text) > 1:
+            if text[1] in CURRENCY_SYMBOLS:
+                symbol = text[1]
+                text = '-' + text[2:].strip()
+            else:
+                text = text.strip()
+        elif text and text[0] in CURRENCY_SYMBOLS:
+            symbol = text[0]
+            text = text[1:].strip()
+        if profit_loss:
+            return text
+        symbol = symbol or section_symbol
+        return f"{symbol} {text}" if symbol else text
+
+    report = CurrencyReport()
+    section_symbol = ''
+
+    if players := snapshot.get("active_players"):
+        report.active_this = players["this_period"]
+        report.active_last = players["last_period"]
+
+    if comm := snapshot.get("commissions"):
+        report.commission_this = spaced(comm["this_period"])
+        report.commission_last = spaced(comm["last_period"])
+        if comm["this_period"] and comm["this_period"][0] in CURRENCY_SYMBOLS:
+            section_symbol = comm["this_period"][0]
+
+    if money := snapshot.get("withdrawable"):
+        report.withdrawable_symbol = money["symbol"]
+        report.withdrawable = money["amount"]
+
+    periods = {"Today", "Yesterday", "This Week", "This Month", "Last Month"}
+    for section_name, section in snapshot.get("sections", {}).items():
+        # Turnover only has monthly rows worth showing
+        allowed = {"This Month", "Last Month"} if section_name == "Turnover" else periods
+
+        rows = []
+        for cells in section["rows"]:
+            if section_name == "Registered Users":
+                if len(cells) >= 2 and cells[0]["text"] in allowed:
+                    rows.append(ReportRow(cells[0]["text"], cells[1]["text"]))
+                continue
+
+            if len(cells) < 3 or cells[0]["text"] not in allowed:
+                continue
+
+            # ONLY apply negative handling to Profit & Loss section
+            profit_loss = section_name == "Affiliate Profit & Loss"
+            amount = signed_text(cells[2]) if profit_loss else cells[2]["text"]
+            rows.append(ReportRow(cells[0]["text"], cells[1]["text"], shown_amount(amount, section_symbol, profit_loss)))
+
+        if rows:
+            report.sections[section_name] = rows
+
+    return report
+
+def scrape_single_currency(driver, backend=None):
+    """Scrape data for the current currency"""
+    backend = backend or SCRAPE_BACKEND
+    try:
+        snapshot = None
+        if backend == "js":
+            snapshot = snapshot_dashboard_js(driver)
+        elif backend == "html":
+            snapshot = snapshot_dashboard_html(capture_page_source(driver))
+        if snapshot is None:
+            snapshot = snapshot_dashboard_elements(driver)
+        return build_currency_report(snapshot)
+    except Exception as e:
+        logger.error(f"Scraping failed: {str(e)}")
+        return None
+
+def scrape_currencies_in_tabs(driver, currencies, on_report=None):
+    """Scrape currencies CURRENCY_FANOUT at a time, each in a tab of the same logged-in browser.
+
+    Every tab in a batch is switched first so the dashboards refresh concurrently,
+    then each is read in turn. Results keep the dropdown order.
+    """
+    main_tab = driver.current_window_handle
+    known = set(driver.window_handles)
+    for _ in range(min(CURRENCY_FANOUT, len(currencies)) - 1):
+        driver.execute_script("window.open(arguments[0], '_blank');", DASHBOARD_URL)
+    tabs = [main_tab] + [h for h in driver.window_handles if h not in known]
+
+    reports = {}
+    retry = []
+    try:
+        for start in range(0, len(currencies), len(tabs)):
+            batch = []
+            for tab, currency in zip(tabs, currencies[start:start + len(tabs)]):
+                logger.info(f"Scraping for currency: {currency['text']}")
+                try:
+                    driver.switch_to.window(tab)
+                    switched = start_currency_switch(driver, currency['value'])
+                    batch.append((tab, currency, switched))
+                except Exception as e:
+                    logger.warning(f"Could not switch tab to {currency['text']}: {str(e)}")
+                    retry.append(currency)
+
+            # The tabs refresh concurrently; by the time one is done the others are usually too
+            for tab, currency, switched in batch:
+                driver.switch_to.window(tab)
+                if switched and not wait_for_refresh(driver, currency['text']):
+                    retry.append(currency)
+                    continue
+                if selected_currency(driver) != currency['value']:
+                    retry.append(currency)
+                    continue
+                report = scrape_single_currency(driver)
+                if report:
+                    reports[currency['text']] = report
+                    if on_report:
+                        on_report(currency['text'], report)
+    finally:
+        for tab in tabs[1:]:
+            try:
+                driver.switch_to.window(tab)
+                driver.close()
+            except Exception:
+                pass
+        driver.switch_to.window(main_tab)
+
+    # Anything a tab couldn't handle is done the slow way in the main tab, starting from a
+    # freshly loaded dashboard so a half-finished switch can't pass as done
+    for currency in retry:
+        logger.info(f"Retrying currency sequentially: {currency['text']}")
+        try:
+            driver.get(DASHBOARD_URL)
+            WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.CLASS_NAME, "panel")))
+        except Exception as e:
+            logger.error(f"Could not reload the dashboard for {currency['text']}: {str(e)}")
+            continue
+        if change_currency(driver, currency['value']):
+            report = scrape_single_currency(driver)
+            if report:
+                reports[currency['text']] = report
+                if on_report:
+                    on_report(currency['text'], report)
+        else:
+            logger.error(f"Failed to change to currency: {currency['text']}")
+
+    return {c['text']: reports[c['text']] for c in currencies if c['text'] in reports}
+
+def scrape_currencies(driver, currencies, on_report=None):
+    """Scrape every currency in dropdown order; returns {currency text: report}.
+
+    `on_report(currency, report)` is called as each currency is done, so callers can
+    show results before the whole account is scraped.
+    """
+    if CURRENCY_FANOUT > 1 and len(currencies) > 1:
+        return scrape_currencies_in_tabs(driver, currencies, on_report)
+
+    currency_reports = {}
+    pending = []  # html backend: (currency, parse future)
+    for currency in currencies:
+        logger.info(f"Scraping for currency: {currency['text']}")
+
+        # Change currency
+        if not change_currency(driver, currency['value']):
+            logger.error(f"Failed to change to currency: {currency['text']}")
+            continue
+
+        if SCRAPE_BACKEND == "html":
+            # Parse on a worker thread while the browser moves on to the next currency
+            try:
+                html = capture_page_source(driver, currency['text'])
+            except Exception as e:
+                logger.warning(f"Could not capture page for {currency['text']}: {str(e)}")
+                html = ""
+            pending.append((currency, html_parse_executor.submit(snapshot_dashboard_html, html)))
+            continue
+
+        # Scrape data for this currency
+        report = scrape_single_currency(driver)
+        if report:
+            currency_reports[currency['text']] = report
+            if on_report:
+                on_report(currency['text'], report)
+
+    for currency, future in pending:
+        snapshot = future.result()
+        if snapshot is None:
+            # Unrecognised page: go back and read this currency element by element
+            report = None
+            if change_currency(driver, currency['value']):
+                report = scrape_single_currency(driver, backend="elements")
+        else:
+            report = build_currency_report(snapshot)
+        if report:
+            currency_reports[currency['text']] = report
+            if on_report:
+                on_report(currency['text'], report)
+
+    return currency_reports
+
+# One adapter (and so one keep-alive connection pool) shared by every account's HTTP session
+http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+
+def new_http_session():
+    session = requests.Session()
+    session.mount("https://", http_adapter)
+    session.mount("http://", http_adapter)
+    session.headers["User-Agent"] = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36"
+    )
+    return session
+
+def cookies_to_http(session, cookies):
+    """Load Selenium-style cookie dicts (as kept by session_store) into a requests session"""
+    for cookie in cookies:
+        session.cookies.set(
+            cookie["name"], cookie["value"],
+            domain=cookie.get("domain", ""), path=cookie.get("path", "/")
+        )
+
+def cookies_from_http(session):
+    """Export a requests cookie jar as Selenium-style cookie dicts for session_store"""
+    cookies = []
+    for c in session.cookies:
+        cookie = {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "secure": bool(c.secure)}
+        if c.expires:
+            cookie["expiry"] = c.expires
+        if c.has_nonstandard_attr("HttpOnly"):
+            cookie["httpOnly"] = True
+        cookies.append(cookie)
+    return cookies
+
+class LoginRejected(Exception):
+    """e2.partners answered a submitted login form with an error on the login page (wrong credentials)"""
+
+# A visible error message on login.jsp; without one, landing back on the login page may
+# just mean a step plain HTTP can't do (scripted checks, a captcha)
+LOGIN_ERROR_XPATH = (
+    "//*[@role='alert' or contains(@class, 'error') or contains(@id, 'error') or contains(@class, 'alert-danger')]"
+    "[normalize-space()]"
+)
+
+def http_login(session, username: str, password: str):
+    """Submit the login.jsp form over HTTP; returns the dashboard response.
+
+    None if the form isn't recognised or the login didn't go through for no stated
+    reason (the browser can still try); raises LoginRejected if the page says the
+    credentials are wrong.
+    """
+    resp = session.get(LOGIN_URL, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    root = lxml.html.fromstring(resp.text)
+    forms = [f for f in root.forms if f.xpath(".//input[@name='userId']")]
+    if not forms:
+        logger.warning("Login form not recognised")
+        return None
+
+    form = forms[0]
+    form_fields = dict(form.form_values())
+    form_fields["userId"] = username
+    form_fields["password"] = password
+    action = urljoin(resp.url, form.get("action") or LOGIN_URL)
+    if (form.method or "GET").upper() == "POST":
+        resp = session.post(action, data=form_fields, timeout=HTTP_TIMEOUT)
+    else:
+        resp = session.get(action, params=form_fields, timeout=HTTP_TIMEOUT)
+
+    if "login.jsp" in resp.url and lxml.html.fromstring(resp.text).xpath(LOGIN_ERROR_XPATH):
+        raise LoginRejected(username)
+    if "index.jsp" not in resp.url:
+        resp = session.get(DASHBOARD_URL, timeout=HTTP_TIMEOUT)
+    if "login.jsp" in resp.url:
+        metrics.incr("http_scrape.login_unclear")
+        logger.warning("HTTP login landed back on login.jsp without an error, leaving it to the browser")
+        return None
+    return resp
+
+def http_currencies(html):
+    """Options of the dashboardCurrency <select>, plus which one the page is showing"""
+    root = lxml.html.fromstring(html)
+    options = root.xpath("//select[@id='dashboardCurrency']/option")
+    currencies = [{'value': o.get("value"), 'text': o.text_content().strip()} for o in options]
+    selected = next((o.get("value") for o in options if o.get("selected") is not None), None)
+    if selected is None and currencies:
+        selected = currencies[0]['value']
+    return currencies, selected
+
+def http_report(html):
+    """Report for a dashboard page fetched over HTTP; None unless the server rendered the numbers"""
+    snapshot = snapshot_dashboard_html(html)
+    if not snapshot or not snapshot["commissions"]["this_period"]:
+        return None
+    return build_currency_report(snapshot)
+
+def http_dashboard(session, username: str, password: str, user_id: int):
+    """Dashboard response for a logged-in HTTP session (cached cookies or a fresh login), or None"""
+    cookies = session_store.get(user_id, username)
+    if cookies:
+        cookies_to_http(session, cookies)
+        resp = session.get(DASHBOARD_URL, timeout=HTTP_TIMEOUT)
+        if "login.jsp" not in resp.url:
+            return resp
+        session_store.invalidate(user_id, username)
+        session.cookies.clear()
+    resp = http_login(session, username, password)
+    if resp is not None:
+        session_store.put(user_id, username, cookies_from_http(session))
+    return resp
+
+def http_currency_page(session, currency, selected, resp):
+    """Dashboard HTML for `currency`; None if the server ignored the switch"""
+    if currency['value'] == selected:
+        return resp.text
+    page = session.get(DASHBOARD_URL, params={HTTP_CURRENCY_PARAM: currency['value']}, timeout=HTTP_TIMEOUT)
+    if http_currencies(page.text)[1] != currency['value']:
+        logger.warning(f"Dashboard ignored currency switch to {currency['text']}")
+        return None
+    return page.text
+
+def scrape_data_http(username: str, password: str, user_id: int, on_report=None, preferred=None):
+    """Scrape every currency with plain HTTP requests; None if the pages don't look as expected.
+
+    In lazy currency mode only the preferred (default: first) currency is fetched.
+    """
+    session = new_http_session()
+    try:
+        resp = http_dashboard(session, username, password, user_id)
+        if resp is None:
+            return None
+
+        currencies, selected = http_currencies(resp.text)
+        if not currencies:
+            report = http_report(resp.text)
+            return {'DEFAULT': report} if report else None
+
+        target = next((c for c in currencies if c['text'] == preferred), currencies[0])
+        currency_reports = {}
+        for currency in currencies:
+            if LAZY_CURRENCIES and currency is not target:
+                currency_reports[currency['text']] = None
+                continue
+            html = http_currency_page(session, currency, selected, resp)
+            if html is None:
+                return None
+            report = http_report(html)
+            if not report:
+                return None
+            currency_reports[currency['text']] = report
+            if on_report:
+                on_report(currency['text'], report)
+        return currency_reports
+    except LoginRejected:
+        raise
+    except Exception as e:
+        logger.warning(f"HTTP scraping failed: {str(e)}")
+        return None
+
+def scrape_currency_http(username: str, password: str, user_id: int, currency: str):
+    """One currency over HTTP for lazy navigation; None if that doesn't work"""
+    session = new_http_session()
+    try:
+        resp = http_dashboard(session, username, password, user_id)
+        if resp is None:
+            return None
+        currencies, selected = http_currencies(resp.text)
+        target = next((c for c in currencies if c['text'] == currency), None)
+        html = http_currency_page(session, target, selected, resp) if target else None
+        return http_report(html) if html else None
+    except LoginRejected:
+        raise
+    except Exception as e:
+        logger.warning(f"HTTP scraping of {currency} failed: {str(e)}")
+        return None
+
+def scrape_data(username: str, password: str, user_id: int, on_report=None, preferred=None):
+    """Scrape data for all available currencies; concurrent scrapes of the same login are shared.
+
+    `on_report(currency, report)` is called from the scrape thread as each currency is
+    done. Callers that joined another caller's scrape only get the final result.
+    Every caller gets the result recorded in its own report history.
+    """
+    key = login_key(username, password)
+    if LAZY_CURRENCIES:
+        # The result depends on the preferred currency and parks a warm driver for this user
+        key += (user_id, preferred)
+    scraped_by, reports = scrape_flights.do(key, _scrape_as, username, password, user_id, on_report, preferred)
+    if scraped_by != user_id:
+        # Joined another user's scrape of this login: reuse the session it logged in with
+        session_store.share(scraped_by, user_id, username)
+    if reports:
+        report_history.record(user_id, username, reports)
+    return reports
+
+def _scrape_as(username: str, password: str, user_id: int, on_report=None, preferred=None):
+    """(user_id, reports): the shared result says whose session and drivers the scrape used"""
+    return user_id, _scrape_data(username, password, user_id, on_report, preferred)
+
+def _scrape_data(username: str, password: str, user_id: int, on_report=None, preferred=None):
+    """Scrape data for all available currencies (only `preferred` in lazy currency mode)"""
+    if SCRAPE_MODE == "http":
+        start = time.monotonic()
+        try:
+            reports = scrape_data_http(username, password, user_id, on_report, preferred)
+        except LoginRejected:
+            # A browser login would be refused too
+            metrics.incr("http_scrape.login_rejected")
+            logger.warning(f"Login rejected for {username}")
+            return None
+        if reports:
+            metrics.incr("http_scrape.ok")
+            metrics.observe("http_scrape.duration", time.monotonic() - start)
+            return reports
+        metrics.incr("http_scrape.fallbacks")
+        logger.info(f"HTTP scrape not usable for {username}, falling back to the browser")
+
+    if LAZY_CURRENCIES:
+        return scrape_data_lazy(username, password, user_id, on_report, preferred)
+
+    # Borrow a warm driver from the pool
+    with driver_pool.driver() as driver:
+        if not driver:
+            return None
+
+        try:
+            # Step 1 & 2: Login (or reuse the cached session) and land on the dashboard
+            open_dashboard(driver, username, password, user_id)
+        
+            # Wait for critical elements to load
+            WebDriverWait(driver, 20).until(
+                EC.presence_of_element_located((By.CLASS_NAME, "panel"))
+            )
+        
+            # Get available currencies
+            currencies = get_available_currencies(driver)
+            if not currencies:
+                logger.info("No currencies found, scraping default")
+                report = scrape_single_currency(driver)
+                if report and on_report:
+                    on_report('DEFAULT', report)
+                return {'DEFAULT': report}
+        
+            # Scrape data for each currency
+            return scrape_currencies(driver, currencies, on_report)
+        
+        except Exception as e:
+            logger.error(f"Scraping failed: {str(e)}")
+            return None
+
+# Lazy currency mode: only the preferred currency is scraped up front; the others are
+# None placeholders, scraped by scrape_currency() when the user navigates to them
+class WarmSessions:
+    """Logged-in drivers left on an account's dashboard for a short idle window.
+
+    A parked driver is out of the pool until it's taken for the same account's next
+    currency, sits idle for `idle` seconds, or is reclaimed because the pool ran dry.
+    """
+
+    def __init__(self, idle):
+        self.idle = idle
+        self._parked = OrderedDict()   # (user_id, username) -> (expires, driver, currencies)
+        self._lock = threading.Lock()
+
+    def take(self, user_id, username):
+        """(driver, currencies) parked for this account, or (None, None)"""
+        with self._lock:
+            entry = self._parked.pop((user_id, username), None)
+        if entry is None:
+            metrics.incr("warm_sessions.misses")
+            return None, None
+        _, driver, currencies = entry
+        try:
+            logged_out = "login.jsp" in driver.current_url
+        except Exception:
+            logged_out = True
+        if logged_out:
+            driver_pool.checkin(driver, broken=True)
+            metrics.incr("warm_sessions.misses")
+            return None, None
+        metrics.incr("warm_sessions.hits")
+        return driver, currencies
+
+    def park(self, user_id, username, driver, currencies):
+        with self._lock:
+            previous = self._parked.pop((user_id, username), None)
+            self._parked[(user_id, username)] = (time.monotonic() + self.idle, driver, currencies)
+        if previous:
+            driver_pool.checkin(previous[1])
+
+    def evict_oldest(self) -> bool:
+        """Hand the longest-parked driver back to the pool; False if nothing is parked"""
+        with self._lock:
+            if not self._parked:
+                return False
+            _, (_, driver, _) = self._parked.popitem(last=False)
+        driver_pool.checkin(driver)
+        return True
+
+    def reap(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires, _, _) in self._parked.items() if expires <= now]
+            drivers = [self._parked.pop(key)[1] for key in expired]
+        for driver in drivers:
+            driver_pool.checkin(driver)
+
+    def reap_loop(self):
+        while True:
+            time.sleep(min(self.idle, 15))
+            self.reap()
+
+    def close(self):
+        with self._lock:
+            drivers = [driver for _, driver, _ in self._parked.values()]
+            self._parked.clear()
+        for driver in drivers:
+            driver_pool.checkin(driver)
+
+    def stats(self):
+        with self._lock:
+            return {"parked": len(self._parked), "enabled": LAZY_CURRENCIES}
+
+warm_sessions = WarmSessions(WARM_SESSION_IDLE)
+driver_pool.reclaim = warm_sessions.evict_oldest
+metrics.register_gauge("warm_sessions", warm_sessions.stats)
+atexit.register(warm_sessions.close)
+
+def lazy_dashboard(username: str, password: str, user_id: int):
+    """(driver, currencies, warm) with `driver` on the account's dashboard; driver is None if none is free"""
+    driver, currencies = warm_sessions.take(user_id, username)
+    if driver is not None:
+        return driver, currencies, True
+
+    driver = driver_pool.checkout()
+    if driver is None:
+        return None, None, False
+    try:
+        open_dashboard(driver, username, password, user_id)
+        WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.CLASS_NAME, "panel")))
+        return driver, get_available_currencies(driver), False
+    except Exception:
+        driver_pool.checkin(driver, broken=True)
+        raise
+
+def read_currency(driver, currency, warm):
+    """Scrape one currency on a dashboard, switching to it (or reloading a warm page already on it)"""
+    if selected_currency(driver) != currency['value']:
+        if not change_currency(driver, currency['value']):
+            return None
+    elif warm:
+        driver.refresh()
+        WebDriverWait(driver, 20).until(EC.presence_of_element_located((By.CLASS_NAME, "panel")))
+    return scrape_single_currency(driver)
+
+def scrape_data_lazy(username: str, password: str, user_id: int, on_report=None, preferred=None):
+    """Scrape only the preferred (default: first) currency and park the logged-in driver"""
+    driver = None
+    try:
+        driver, currencies, warm = lazy_dashboard(username, password, user_id)
+        if driver is None:
+            return None
+
+        if not currencies:
+            logger.info("No currencies found, scraping default")
+            report = scrape_single_currency(driver)
+            driver_pool.checkin(driver)
+            if report and on_report:
+                on_report('DEFAULT', report)
+            return {'DEFAULT': report}
+
+        target = next((c for c in currencies if c['text'] == preferred), currencies[0])
+        report = read_currency(driver, target, warm)
+    except Exception as e:
+        logger.error(f"Scraping failed: {str(e)}")
+        if driver is not None:
+            driver_pool.checkin(driver, broken=True)
+        return None
+
+    warm_sessions.park(user_id, username, driver, currencies)
+    if not report:
+        return None
+    if on_report:
+        on_report(target['text'], report)
+    reports = {c['text']: None for c in currencies}
+    reports[target['text']] = report
+    return reports
+
+def scrape_currency(username: str, password: str, user_id: int, currency: str):
+    """Scrape one currency of an account on demand, on its warm driver when there is one"""
+    report = None
+    if SCRAPE_MODE == "http":
+        try:
+            report = scrape_currency_http(username, password, user_id, currency)
+        except LoginRejected:
+            logger.warning(f"Login rejected for {username}")
+            return None
+
+    driver = None
+    try:
+        if not report:
+            driver, currencies, warm = lazy_dashboard(username, password, user_id)
+            if driver is None:
+                return None
+            target = next((c for c in currencies if c['text'] == currency), None)
+            report = read_currency(driver, target, warm) if target else None
+    except Exception as e:
+        logger.error(f"Scraping {currency} failed: {str(e)}")
+        if driver is not None:
+            driver_pool.checkin(driver, broken=True)
+        return None
+
+    if driver is not None:
+        warm_sessions.park(user_id, username, driver, currencies)
+    if report:
+        report_history.record(user_id, username, {currency: report})
+    return report
+
+def format_report(data: CurrencyReport, account_name: str = "", currency: str = "", last_update: datetime = None):
+    """Format report in Markdown for Telegram (parse_mode='Markdown')."""
+    if not data:
+        return "_No data available. Please try again later._"
+
+    current_myt = get_malaysia_time()
+    
+    # Handle the last_update parameter correctly
+    if last_update is None:
+        # Use current MYT time if no last_update provided
+        report_time = current_myt
+    else:
+        # Convert any datetime to MYT
+        if last_update.tzinfo is None:
+            # If naive datetime, assume UTC
+            report_time = last_update.replace(tzinfo=timezone.utc).astimezone(MYT)
+        else:
+            # Convert to MYT if it has timezone info
+            report_time = last_update.astimezone(MYT)
+
+    # Format the header date
+    current_date = report_time.strftime("%a, %B %d")
+    total_width = 65  # tweak to align the date
+    
+    # Add currency to account name if provided
+    display_name = f"⟪ {account_name} ⟫ ({currency})" if currency else account_name
+    padding = max(total_width - len(display_name) - len(current_date), 1)
+    header = f"*{display_name}{' ' * padding}{current_date}*\n"
+
+    msg = [header]
+
+    if data.withdrawable is not None:
+        msg.append(f"*Withdrawable:* `{data.withdrawable_symbol}` `{data.withdrawable}`")
+
+    def shown(text):
+        return "N/A" if text is None else text
+
+    # Active Players and Commissions side by side
+    periods = [
+        ("This Period", shown(data.active_this), shown(data.commission_this)),
+        ("Last Period", shown(data.active_last), shown(data.commission_last)),
+    ]
+    if any(value is not None for value in (data.active_this, data.active_last, data.commission_this, data.commission_last)):
+        # Section headers
+        active_header = "⦗ Active Players ⦘"
+        comm_header = "⦗ Commissions ⦘"
+        padding = 30 - len(active_header)  # Adjust spacing between columns
+        section_headers = f"*{active_header}{' ' * padding}{comm_header}*"
+        msg.append(section_headers)
+        
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+        for label, players, commission in periods:
+            left_part = f"{label} *≅* `{players}`"
+            padding = 30 - len(left_part)
+            right_part = f"{label} - `{commission}`"
+            msg.append(f"{left_part}{' ' * padding}{right_part}")
+
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+    if rows := data.sections.get("Registered Users"):
+        msg.append("*⦗ Registered Users ⦘*")
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+        
+        for row in rows:
+            msg.append(f"• {row.period} ⁃ `{row.count_text}`")
+        
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+    # Other sections
+    sections = [
+        ("First Deposit", "|", True),
+        ("Deposit", "|", True),
+        ("Withdrawal", "|", True),
+        ("Affiliate Profit & Loss", "=", False),
+        ("Turnover", "=", False),
+    ]
+
+    for name, sep, parens in sections:
+        rows = data.sections.get(name)
+        if not rows:
+            continue
+
+        msg.append(f"*⦗ {name} ⦘*")
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+        for row in rows:
+            count_md = f"`{row.count_text}`"
+            amt_md = f"`{shown(row.amount_text)}`"
+
+            if parens:
+                line = f"• {row.period} {sep} {count_md} {sep} ( {amt_md} )"
+            else:
+                line = f"• {row.period} {sep} {amt_md}"
+
+            msg.append(line)
+
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+    # Footer (italic)
+    timestamp = report_time.strftime("%Y-%m-%d %H:%M:%S (MYT)")
+    msg.append(f"_Last updated: {timestamp}_")
+
+    return "\n".join(msg)
+
+
+# Database functions
+class AccountCache:
+    """Per-user copy of affiliate_accounts rows so /fetch, /accounts and fetch-all skip Supabase.
+
+    Writes go through AccountRepository.add_account()/remove_account(), which invalidate
+    the user's entry; `ttl` only bounds how long an out-of-band change can go unseen.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._rows = {}  # user_id -> (loaded_at, [{"username", "password"}, ...])
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._rows.get(user_id)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, user_id, rows):
+        with self._lock:
+            self._rows[user_id] = (time.time(), rows)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._rows.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._rows)}
+
+account_cache = AccountCache(ACCOUNT_CACHE_TTL)
+metrics.register_gauge("account_cache", account_cache.stats)
+
+class AccountStore(abc.ABC):
+    """Storage backend for affiliate_accounts rows; both implementations behave the same"""
+
+    @abc.abstractmethod
+    async def insert(self, user_id: int, username: str, password: str) -> bool:
+        """True if the row was added"""
+
+    @abc.abstractmethod
+    async def delete(self, user_id: int, username: str) -> bool:
+        """True if a row was deleted"""
+
+    @abc.abstractmethod
+    async def list_for_user(self, user_id: int):
+        """[{"username", "password"}, ...] for all of a user's accounts"""
+
+class SupabaseAccountStore(AccountStore):
+    """affiliate_accounts in Supabase through one shared AsyncClient (connections are reused)"""
+
+    def __init__(self, url, key):
+        self.url = url
+        self.key = key
+        self._client = None
+        self._client_lock = asyncio.Lock()
+
+    async def client(self):
+        if self._client is None:
+            async with self._client_lock:
+                if self._client is None:
+                    self._client = await supabase.acreate_client(self.url, self.key)
+        return self._client
+
+    async def insert(self, user_id, username, password):
+        client = await self.client()
+        response = await client.table('affiliate_accounts').insert({
+            'user_id': user_id,
+            'username': username,
+            'password': password
+        }).execute()
+        return bool(response.data)
+
+    async def delete(self, user_id, username):
+        client = await self.client()
+        response = await client.table('affiliate_accounts').delete().eq(
+            'user_id', user_id
+        ).eq('username', username).execute()
+        # Check if any rows were deleted
+        return bool(response.data)
+
+    async def list_for_user(self, user_id):
+        client = await self.client()
+        response = await client.table('affiliate_accounts').select(
+            "username", "password"
+        ).eq('user_id', user_id).execute()
+        return [{'username': r['username'], 'password': r['password']} for r in response.data or []]
+
+class SQLiteAccountStore(AccountStore):
+    """affiliate_accounts in a local SQLite file (WAL, indexed on user_id and username).
+
+    Meant for single-node deployments and offline load tests. Queries run on a single
+    dedicated thread that owns the connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="accounts-db")
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS affiliate_accounts(
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER NOT NULL,
+                                username TEXT NOT NULL,
+                                password TEXT NOT NULL
+                            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_affiliate_accounts_user "
+                         "ON affiliate_accounts(user_id, username)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await run_blocking(self._executor, func, *args)
+
+    def _insert(self, user_id, username, password):
+        conn = self._db()
+        conn.execute("INSERT INTO affiliate_accounts(user_id, username, password) VALUES(?,?,?)",
+                     (user_id, username, password))
+        conn.commit()
+        return True
+
+    def _delete(self, user_id, username):
+        conn = self._db()
+        cur = conn.execute("DELETE FROM affiliate_accounts WHERE user_id = ? AND username = ?", (user_id, username))
+        conn.commit()
+        return cur.rowcount > 0
+
+    def _list_for_user(self, user_id):
+        rows = self._db().execute(
+            "SELECT username, password FROM affiliate_accounts WHERE user_id = ? ORDER BY id", (user_id,)
+        ).fetchall()
+        return [{'username': username, 'password': password} for username, password in rows]
+
+    async def insert(self, user_id, username, password):
+        return await self._run(self._insert, user_id, username, password)
+
+    async def delete(self, user_id, username):
+        return await self._run(self._delete, user_id, username)
+
+    async def list_for_user(self, user_id):
+        return await self._run(self._list_for_user, user_id)
+
+def create_account_store():
+    """Pick the affiliate_accounts backend from ACCOUNT_STORE"""
+    if ACCOUNT_STORE == "sqlite":
+        logger.info(f"Using local SQLite account store at {ACCOUNTS_DB}")
+        return SQLiteAccountStore(ACCOUNTS_DB)
+    return SupabaseAccountStore(SUPABASE_URL, SUPABASE_KEY)
+
+class AccountRepository:
+    """Async access to affiliate_accounts for the bot's handlers, on top of an AccountStore.
+
+    Every call is bounded by `timeout`. Idempotent calls are retried with exponential
+    backoff. Latency is recorded as db.<operation> on /api/metrics. Reads are served
+    from account_cache when possible.
+    """
+
+    def __init__(self, store, timeout, retries, backoff):
+        self.store = store
+        self.timeout = timeout
+        self.retries = max(retries, 1)
+        self.backoff = backoff
+
+    async def _call(self, operation, query, idempotent=True):
+        """Await `query()` with timeout, retries and latency metrics"""
+        attempts = self.retries if idempotent else 1
+        delay = self.backoff
+        for attempt in range(1, attempts + 1):
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(query(), self.timeout)
+                metrics.observe(f"db.{operation}", time.monotonic() - start)
+                return result
+            except Exception as e:
+                metrics.incr(f"db.{operation}.errors")
+                if attempt == attempts:
+                    raise
+                logger.warning(f"Database {operation} failed (attempt {attempt}): {str(e)}; retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def add_account(self, user_id: int, username: str, password: str) -> bool:
+        """Add affiliate account to database"""
+        account_cache.invalidate(user_id)
+        try:
+            # Not retried: a timed-out insert may still have landed
+            return await self._call(
+                "insert", lambda: self.store.insert(user_id, username, password), idempotent=False
+            )
+        except Exception as e:
+            logger.error(f"Database error: {str(e)}")
+            return False
+
+    async def remove_account(self, user_id: int, username: str) -> bool:
+        """Remove affiliate account from database"""
+        account_cache.invalidate(user_id)
+        session_store.invalidate(user_id, username)
+        report_cache.invalidate(user_id, username)
+        prefetcher.forget(user_id, username)
+        report_store.forget(user_id, username)
+        try:
+            await run_blocking(report_history.executor, report_history.forget, user_id, username)
+        except Exception as e:
+            logger.error(f"Failed to delete report history for {username}: {str(e)}")
+        try:
+            # Not retried: a timed-out delete may still have landed, and the retry would
+            # then report the account as not found
+            return await self._call("delete", lambda: self.store.delete(user_id, username), idempotent=False)
+        except Exception as e:
+            logger.error(f"Database error: {str(e)}")
+            return False
+
+    async def get_user_credentials(self, user_id: int):
+        """Get (username, password) rows for all of a user's accounts in one query"""
+        rows = account_cache.get(user_id)
+        if rows is not None:
+            metrics.incr("account_cache.hits")
+            return rows
+
+        metrics.incr("account_cache.misses")
+        try:
+            rows = await self._call("select", lambda: self.store.list_for_user(user_id))
+            account_cache.put(user_id, rows)
+            return rows
+        except Exception as e:
+            logger.error(f"Database error: {str(e)}")
+            return []
+
+    async def get_user_accounts(self, user_id: int):
+        """Get all affiliate accounts for a user"""
+        return [account['username'] for account in await self.get_user_credentials(user_id)]
+
+    async def get_account_credentials(self, user_id: int, username: str):
+        """Get credentials for a specific account"""
+        return next((r for r in await self.get_user_credentials(user_id) if r['username'] == username), None)
+
+accounts_db = AccountRepository(create_account_store(), DB_TIMEOUT, DB_RETRIES, DB_RETRY_BACKOFF)
+
+# Report cache
+class ReportCache:
+    """Scraped reports per (user_id, account).
+
+    Entries are fresh for `ttl` seconds. After that they are served stale, with a
+    background refresh, until `stale_ttl`. The least recently used entries are
+    evicted beyond `max_size`.
+    """
+
+    def __init__(self, ttl, stale_ttl, max_size):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (user_id, account) -> (fetched_at, reports)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, account):
+        """(reports, fetched_at, is_fresh), or None on a miss"""
+        key = (user_id, account)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                fetched_at, reports = entry
+                age = (datetime.now(timezone.utc) - fetched_at).total_seconds()
+                if age <= self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    fresh = age <= self.ttl
+                    metrics.incr("report_cache.hits" if fresh else "report_cache.stale_hits")
+                    return reports, fetched_at, fresh
+                del self._entries[key]
+        metrics.incr("report_cache.misses")
+        return None
+
+    def put(self, user_id, account, reports, fetched_at=None):
+        key = (user_id, account)
+        with self._lock:
+            self._entries[key] = (fetched_at or datetime.now(timezone.utc), reports)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id, account):
+        with self._lock:
+            self._entries.pop((user_id, account), None)
+
+    def age(self, user_id, account):
+        """Seconds since the cached report was scraped, None if not cached (doesn't count as a lookup)"""
+        with self._lock:
+            entry = self._entries.get((user_id, account))
+        if entry is None:
+            return None
+        return (datetime.now(timezone.utc) - entry[0]).total_seconds()
+
+    def begin_refresh(self, user_id, account) -> bool:
+        """Claim the background refresh for an entry; False if one is already running"""
+        with self._lock:
+            if (user_id, account) in self._refreshing:
+                return False
+            self._refreshing.add((user_id, account))
+            return True
+
+    def end_refresh(self, user_id, account):
+        with self._lock:
+            self._refreshing.discard((user_id, account))
+
+    def stats(self):
+        hits, stale = metrics.get("report_cache.hits"), metrics.get("report_cache.stale_hits")
+        lookups = hits + stale + metrics.get("report_cache.misses")
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "refreshing": len(self._refreshing),
+                "hit_rate": round((hits + stale) / lookups, 3) if lookups else None,
+            }
+
+report_cache = ReportCache(CACHE_DURATION, REPORT_STALE_TTL, REPORT_CACHE_SIZE)
+metrics.register_gauge("report_cache", report_cache.stats)
+
+def deep_sizeof(obj, seen=None):
+    """Rough bytes held by `obj` and everything it references (dicts, sequences, slotted objects)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__") and not isinstance(obj, (str, bytes, int, float, Decimal)):
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name != "_bot" and hasattr(obj, name):
+                    size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+class ReportStore:
+    """The reports each user is navigating, with their rendered messages.
+
+    Entries are per (user_id, account) and hold the reports, their fetch time and
+    the Markdown + keyboard of every currency rendered so far, so pressing ❮❮❮/❯❯❯
+    again is a dict lookup. Each user keeps at most `max_accounts` (least recently
+    used go first) and entries expire after `ttl` seconds. Memory use is tracked.
+    """
+
+    def __init__(self, ttl, max_accounts):
+        self.ttl = ttl
+        self.max_accounts = max_accounts
+        self._users = {}      # user_id -> OrderedDict(account -> entry)
+        self._bytes = 0
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def put(self, user_id, account, reports, fetched_at):
+        # A copy: update() adds currencies, and the caller's dict is shared with report_cache
+        reports = dict(reports)
+        entry = {"reports": reports, "fetched_at": fetched_at, "times": {}, "rendered": {},
+                 "stored": time.monotonic()}
+        with self._lock:
+            # Streaming re-puts the account once per currency: only new reports are measured
+            accounts = self._users.get(user_id)
+            previous = accounts.get(account) if accounts else None
+            entry["sizes"] = {
+                currency: previous["sizes"][currency]
+                if previous is not None and previous["reports"].get(currency) is report
+                else sys.getsizeof(currency) + deep_sizeof(report)
+                for currency, report in reports.items()
+            }
+            entry["bytes"] = sys.getsizeof(reports) + sum(entry["sizes"].values())
+            self._drop(user_id, account)
+            accounts = self._users.setdefault(user_id, OrderedDict())
+            accounts[account] = entry
+            self._bytes += entry["bytes"]
+            while len(accounts) > self.max_accounts:
+                self._drop(user_id, next(iter(accounts)))
+                metrics.incr("report_store.evictions")
+            if time.monotonic() - self._last_sweep > 60:
+                self._sweep()
+
+    def get(self, user_id, account):
+        """(reports, fetched_at), or None if missing or expired"""
+        with self._lock:
+            entry = self._entry(user_id, account)
+            return None if entry is None else (entry["reports"], entry["fetched_at"])
+
+    def update(self, user_id, account, currency, report):
+        """Add a currency scraped after the rest (lazy currency mode)"""
+        with self._lock:
+            entry = self._entry(user_id, account)
+            if entry is None:
+                return
+            measured = sys.getsizeof(currency) + deep_sizeof(report)
+            size = measured - entry["sizes"].get(currency, 0)
+            entry["sizes"][currency] = measured
+            entry["reports"][currency] = report
+            entry["times"][currency] = datetime.now(timezone.utc)
+            self._forget_render(entry, currency)
+            entry["bytes"] += size
+            self._bytes += size
+
+    def render(self, user_id, account, currency=None):
+        """(text, markup) for one currency (default: the first scraped), rendered once; None if not stored"""
+        with self._lock:
+            entry = self._entry(user_id, account)
+            if entry is None:
+                return None
+            reports = entry["reports"]
+            if reports.get(currency) is None:
+                currency = next((c for c, report in reports.items() if report is not None), None)
+            if currency is None:
+                return None
+            rendered = entry["rendered"].get(currency)
+            if rendered is not None:
+                metrics.incr("report_store.render_hits")
+                return rendered
+
+        metrics.incr("report_store.render_misses")
+        rendered = render_account_report(account, reports, entry["times"].get(currency, entry["fetched_at"]), currency)
+        size = deep_sizeof(rendered)
+        with self._lock:
+            if self._entry(user_id, account) is entry and currency not in entry["rendered"]:
+                entry["rendered"][currency] = rendered
+                entry["bytes"] += size
+                self._bytes += size
+        return rendered
+
+    def forget(self, user_id, account):
+        with self._lock:
+            self._drop(user_id, account)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "entries": sum(len(accounts) for accounts in self._users.values()),
+                "rendered": sum(len(e["rendered"]) for accounts in self._users.values() for e in accounts.values()),
+                "bytes": self._bytes,
+            }
+
+    def _entry(self, user_id, account):
+        """Live entry (marked recently used) or None; caller holds the lock"""
+        accounts = self._users.get(user_id)
+        entry = accounts.get(account) if accounts else None
+        if entry is None:
+            return None
+        if time.monotonic() - entry["stored"] > self.ttl:
+            self._drop(user_id, account)
+            return None
+        accounts.move_to_end(account)
+        return entry
+
+    def _forget_render(self, entry, currency):
+        rendered = entry["rendered"].pop(currency, None)
+        if rendered is not None:
+            size = deep_sizeof(rendered)
+            entry["bytes"] -= size
+            self._bytes -= size
+
+    def _drop(self, user_id, account):
+        accounts = self._users.get(user_id)
+        entry = accounts.pop(account, None) if accounts else None
+        if entry is not None:
+            self._bytes -= entry["bytes"]
+        if accounts is not None and not accounts:
+            del self._users[user_id]
+
+    def _sweep(self):
+        now = time.monotonic()
+        for user_id, accounts in list(self._users.items()):
+            for account, entry in list(accounts.items()):
+                if now - entry["stored"] > self.ttl:
+                    self._drop(user_id, account)
+        self._last_sweep = now
+
+report_store = ReportStore(REPORT_STORE_TTL, REPORT_STORE_ACCOUNTS)
+metrics.register_gauge("report_store", report_store.stats)
+
+def report_markup(account, currency, currency_count):
+    """Currency navigation (multi-currency accounts only) plus force-refresh and trend buttons"""
+    keyboard = []
+    if currency_count > 1:
+        keyboard.append([
+            InlineKeyboardButton("❮❮❮", callback_data=f"nav:{account}:{currency}:prev"),
+            InlineKeyboardButton(currency, callback_data="none"),
+            InlineKeyboardButton("❯❯❯", callback_data=f"nav:{account}:{currency}:next")
+        ])
+    keyboard.append([
+        InlineKeyboardButton("⟳ refresh", callback_data=f"refresh_{account}"),
+        InlineKeyboardButton("trend", callback_data=f"trend:{account}:{currency}")
+    ])
+    return InlineKeyboardMarkup(keyboard)
+
+def render_account_report(account, report_data, fetched_at, currency=None):
+    """Markdown text and keyboard for one currency (default: the first scraped) of an account's report"""
+    currencies = list(report_data.keys())
+    if report_data.get(currency) is None:
+        currency = next((c for c, report in report_data.items() if report is not None), currencies[0])
+    report = format_report(report_data[currency], account, currency, last_update=fetched_at)
+    return report, report_markup(account, currency, len(currencies))
+
+def remember_report(user_id, account, report_data, fetched_at):
+    """Keep a report in the report store for currency navigation"""
+    report_store.put(user_id, account, report_data, fetched_at)
+
+async def cached_report(user_id, account):
+    """report_cache.get(), refilled from the report history on a miss (e.g. after a restart)"""
+    cached = report_cache.get(user_id, account)
+    if cached:
+        return cached
+    stored = await run_blocking(report_history.executor, report_history.latest, user_id, account)
+    if not stored:
+        return None
+    report_data, fetched_at = stored
+    if (datetime.now(timezone.utc) - fetched_at).total_seconds() > report_cache.stale_ttl:
+        return None
+    report_cache.put(user_id, account, report_data, fetched_at)
+    metrics.incr("report_cache.restored")
+    return report_cache.get(user_id, account)
+
+def preferred_currency(context, account):
+    """Currency the user last looked at for `account` (lazy currency mode scrapes it first)"""
+    return context.user_data.get('currency', {}).get(account)
+
+def schedule_refresh(context, user_id, account, chat_id, message_id):
+    """Stale-while-revalidate: re-scrape `account` in the background and update the shown report"""
+    if report_cache.begin_refresh(user_id, account):
+        context.application.create_task(refresh_report(context, user_id, account, chat_id, message_id))
+
+async def refresh_report(context, user_id, account, chat_id, message_id):
+    try:
+        creds = await accounts_db.get_account_credentials(user_id, account)
+        if not creds:
+            return
+        # Queued under its own key so a background refresh doesn't make the user look busy
+        job = scheduler.submit(("refresh", user_id), scrape_data, creds['username'], creds['password'], user_id)
+        report_data = await job.future
+        if not report_data:
+            return
+
+        fetched_at = datetime.now(timezone.utc)
+        report_cache.put(user_id, account, report_data, fetched_at)
+        remember_report(user_id, account, report_data, fetched_at)
+        report, reply_markup = report_store.render(user_id, account)
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message_id,
+            text=report,
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        )
+    except BadRequest as e:
+        if "Message is not modified" not in str(e):
+            logger.error(f"Error editing refreshed report: {str(e)}")
+    except Exception as e:
+        logger.error(f"Background refresh of {account} failed: {str(e)}")
+    finally:
+        report_cache.end_refresh(user_id, account)
+
+class ReportStream:
+    """A scheduled scrape whose currencies can be consumed as they finish.
+
+        stream = ReportStream(user_id, username, password, user_id)
+        async for currency, report in stream: ...
+
+    The scrape thread hands each currency to the event loop as soon as it is read.
+    `stream.job` is the underlying ScrapeJob (queue position, final result).
+    """
+
+    def __init__(self, queue_key, username, password, user_id, preferred=None):
+        loop = asyncio.get_running_loop()
+        self._updates = asyncio.Queue()
+
+        def on_report(currency, report):
+            loop.call_soon_threadsafe(self._updates.put_nowait, (currency, report))
+
+        self.job = scheduler.submit(queue_key, scrape_data, username, password, user_id, on_report, preferred)
+        # Queued after every on_report() of the scrape, so it always comes last
+        self.job.future.add_done_callback(lambda _: self._updates.put_nowait(None))
+
+    async def __aiter__(self):
+        streamed = set()
+        while (update := await self._updates.get()) is not None:
+            streamed.add(update[0])
+            yield update
+        # A scrape we joined through single-flight only hands over its final result
+        for currency, report in (self.job.future.result() or {}).items():
+            if currency not in streamed:
+                yield currency, report
+
+async def stream_report(context, stream, user_id, account, started, show):
+    """Put an account's report on screen as soon as its first currency is scraped.
+
+    `show(text, markup)` displays the first currency and returns the Message. The
+    navigation buttons are added once a second currency arrives; later ones just join
+    the stored report. Returns the reports in dropdown order and their fetch time, or
+    (None, None) if nothing was scraped.
+    """
+    reports, fetched_at, message = {}, None, None
+    async for currency, report in stream:
+        if not report:
+            continue
+        reports[currency] = report
+        if message is None:
+            fetched_at = datetime.now(timezone.utc)
+            metrics.observe("report.time_to_first", time.monotonic() - started)
+            remember_report(user_id, account, reports, fetched_at)
+            report_text, reply_markup = report_store.render(user_id, account)
+            message = await show(report_text, reply_markup)
+            first_currency = currency
+            continue
+
+        # Rendered navigation depends on how many currencies there are
+        remember_report(user_id, account, reports, fetched_at)
+        if len(reports) == 2:
+            try:
+                await message.edit_reply_markup(reply_markup=report_markup(account, first_currency, 2))
+            except BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    logger.error(f"Error adding navigation for {account}: {str(e)}")
+
+    if not reports:
+        return None, None
+    result = stream.job.future.result() or {}
+    if any(report is not None for report in result.values()):
+        if len(result) > 1 and len(reports) == 1:
+            # Lazy currency mode: the rest are placeholders, scraped when navigated to
+            try:
+                await message.edit_reply_markup(reply_markup=report_markup(account, first_currency, len(result)))
+            except BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    logger.error(f"Error adding navigation for {account}: {str(e)}")
+        reports = result
+    remember_report(user_id, account, reports, fetched_at)
+    metrics.observe("report.time_to_complete", time.monotonic() - started)
+    return reports, fetched_at
+
+async def post_account_report(context, stream, user_id, account, chat_id, started):
+    """fetch all: post one account's report as soon as its first currency is in"""
+    try:
+        report_data, fetched_at = await stream_report(
+            context, stream, user_id, account, started,
+            lambda text, markup: context.bot.send_message(
+                chat_id=chat_id, text=text, parse_mode="Markdown", reply_markup=markup
+            )
+        )
+    except Exception as e:
+        logger.error(f"Fetching {account} failed: {str(e)}")
+        report_data = None
+
+    if report_data:
+        report_cache.put(user_id, account, report_data, fetched_at)
+    else:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"*Failed to fetch data for account `{account}`*",
+            parse_mode="Markdown"
+        )
+
+# Report history
+def report_points(report):
+    """(section, period, count, amount) rows of one CurrencyReport for the history tables"""
+    def amount(text):
+        money = parse_money(text)
+        return None if money is None else float(money.amount)
+
+    points = []
+    for period, players, commission in (("This Period", report.active_this, report.commission_this),
+                                        ("Last Period", report.active_last, report.commission_last)):
+        if (count := parse_count(players)) is not None:
+            points.append(("Active Players", period, count, None))
+        if (value := amount(commission)) is not None:
+            points.append(("Commissions", period, None, value))
+    if (value := amount(report.withdrawable)) is not None:
+        points.append(("Withdrawable", "Now", None, value))
+
+    for name, rows in report.sections.items():
+        for row in rows:
+            points.append((name, row.period, row.count, None if row.amount is None else float(row.amount)))
+    return points
+
+class ReportHistory:
+    """Every scraped report, kept in a local SQLite time series.
+
+    Each scrape stores one row per (account, currency) with the report itself (to
+    re-render it without scraping) and its numbers as typed values per section and
+    period (for trends). Scrapes older than `raw_days` are downsampled to the last
+    one per MYT day; anything older than `retention_days` is deleted. latest() only
+    combines currencies scraped within `latest_window` seconds of the newest one.
+    """
+
+    def __init__(self, path, retention_days, raw_days, prune_interval, latest_window):
+        self.path = path
+        self.latest_window = latest_window
+        self.retention = retention_days * 86400
+        self.raw = raw_days * 86400
+        self.prune_interval = prune_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-history")
+        self._conn = None
+        self._last_prune = 0
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scrapes(
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id INTEGER NOT NULL,
+                                account TEXT NOT NULL,
+                                currency TEXT NOT NULL,
+                                ts INTEGER NOT NULL,
+                                report TEXT NOT NULL
+                            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_scrapes_account ON scrapes(account, currency, ts)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scrape_values(
+                                scrape_id INTEGER NOT NULL REFERENCES scrapes(id) ON DELETE CASCADE,
+                                section TEXT NOT NULL,
+                                period TEXT NOT NULL,
+                                count INTEGER,
+                                amount REAL
+                            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_scrape_values_scrape ON scrape_values(scrape_id)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def record(self, user_id, account, reports, ts=None):
+        """Store one scrape of an account (all currencies); never raises"""
+        ts = int(ts or time.time())
+        try:
+            with self._lock:
+                conn = self._db()
+                for currency, report in reports.items():
+                    if not report:
+                        continue
+                    cur = conn.execute(
+                        "INSERT INTO scrapes(user_id, account, currency, ts, report) VALUES(?,?,?,?,?)",
+                        (user_id, account, currency, ts, json.dumps(report.to_dict()))
+                    )
+                    conn.executemany(
+                        "INSERT INTO scrape_values(scrape_id, section, period, count, amount) VALUES(?,?,?,?,?)",
+                        [(cur.lastrowid, *point) for point in report_points(report)]
+                    )
+                conn.commit()
+            metrics.incr("report_history.recorded")
+            if ts - self._last_prune >= self.prune_interval:
+                self.prune(ts)
+        except Exception as e:
+            logger.error(f"Failed to record report history for {account}: {str(e)}")
+
+    def prune(self, now=None):
+        """Apply retention and downsampling"""
+        now = int(now or time.time())
+        raw_cutoff = now - self.raw
+        with self._lock:
+            conn = self._db()
+            conn.execute("DELETE FROM scrapes WHERE ts < ?", (now - self.retention,))
+            # Keep the last scrape of each MYT day once it's older than raw_days
+            conn.execute("""DELETE FROM scrapes WHERE ts < ? AND id NOT IN (
+                                SELECT MAX(id) FROM scrapes WHERE ts < ?
+                                GROUP BY user_id, account, currency, (ts + 28800) / 86400
+                            )""", (raw_cutoff, raw_cutoff))
+            conn.commit()
+            self._last_prune = now
+
+    def forget(self, user_id, account):
+        with self._lock:
+            conn = self._db()
+            conn.execute("DELETE FROM scrapes WHERE account = ? AND user_id = ?", (account, user_id))
+            conn.commit()
+
+    def latest(self, user_id, account):
+        """(reports, fetched_at) with the newest stored scrape of each of the account's currencies, or None
+
+        Lazy currency mode records currencies one at a time, so they're collected per
+        currency (in the order they were first seen), leaving out any scraped more than
+        `latest_window` seconds before the newest; fetched_at is the oldest kept.
+        """
+        with self._lock:
+            rows = self._db().execute(
+                """SELECT s.currency, s.report, s.ts
+                   FROM scrapes s JOIN (SELECT MAX(id) AS last, MIN(id) AS first FROM scrapes
+                                        WHERE account = ? AND user_id = ? GROUP BY currency) g
+                     ON s.id = g.last
+                   ORDER BY g.first""",
+                (account, user_id)
+            ).fetchall()
+        if not rows:
+            return None
+        newest = max(ts for _, _, ts in rows)
+        rows = [row for row in rows if row[2] >= newest - self.latest_window]
+        reports = {currency: CurrencyReport.from_dict(json.loads(report)) for currency, report, _ in rows}
+        return reports, datetime.fromtimestamp(min(ts for _, _, ts in rows), timezone.utc)
+
+    def values_at(self, user_id, account, currency, ts):
+        """(scraped ts, {(section, period): (count, amount)}) of the last scrape at or before ts, or None"""
+        with self._lock:
+            conn = self._db()
+            row = conn.execute(
+                "SELECT id, ts FROM scrapes WHERE account = ? AND currency = ? AND ts <= ? AND user_id = ? "
+                "ORDER BY ts DESC, id DESC LIMIT 1",
+                (account, currency, int(ts), user_id)
+            ).fetchone()
+            if row is None:
+                return None
+            values = conn.execute(
+                "SELECT section, period, count, amount FROM scrape_values WHERE scrape_id = ?", (row[0],)
+            ).fetchall()
+        return row[1], {(section, period): (count, amount) for section, period, count, amount in values}
+
+    def daily(self, user_id, account, currency, days):
+        """{MYT date: {section: (count, amount)}} of the "Today" rows at the end of each of the last `days` days"""
+        first_day = get_malaysia_time().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        since = int(first_day.timestamp())
+        with self._lock:
+            rows = self._db().execute(
+                """SELECT s.ts, v.section, v.count, v.amount
+                   FROM scrapes s JOIN scrape_values v ON v.scrape_id = s.id
+                   WHERE s.id IN (SELECT MAX(id) FROM scrapes
+                                  WHERE account = ? AND currency = ? AND ts >= ? AND user_id = ?
+                                  GROUP BY (ts + 28800) / 86400)
+                     AND v.period = 'Today'
+                   ORDER BY s.ts""",
+                (account, currency, since, user_id)
+            ).fetchall()
+        result = {}
+        for ts, section, count, amount in rows:
+            day = datetime.fromtimestamp(ts, MYT).date()
+            result.setdefault(day, {})[section] = (count, amount)
+        return result
+
+report_history = ReportHistory(REPORT_DB, REPORT_RETENTION_DAYS, REPORT_RAW_DAYS, REPORT_PRUNE_INTERVAL, REPORT_STALE_TTL)
+
+TREND_SECTIONS = ["Registered Users", "First Deposit", "Deposit", "Withdrawal", "Affiliate Profit & Loss"]
+
+def format_trend(account, currency, now_values, yesterday_values, daily):
+    """Markdown "today vs yesterday" and last-days view built from report history"""
+    def amount_md(value):
+        return f"`{value:,.2f}`"
+
+    msg = [f"*⟪ {account} ⟫ ({currency}) trend*\n"]
+
+    now_ts, now_points = now_values
+    msg.append("*⦗ Today vs yesterday ⦘*")
+    msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    if yesterday_values:
+        then_ts, then_points = yesterday_values
+        now_time = datetime.fromtimestamp(now_ts, MYT).strftime("%H:%M")
+        then_time = datetime.fromtimestamp(then_ts, MYT).strftime("%a %H:%M")
+        msg.append(f"_{now_time} today vs {then_time}_")
+    else:
+        then_points = {}
+        msg.append("_No scrape from yesterday yet_")
+
+    for name in TREND_SECTIONS:
+        if (name, "Today") not in now_points:
+            continue
+        count, amount = now_points[(name, "Today")]
+        old_count, old_amount = then_points.get((name, "Today"), (None, None))
+        line = f"• {name} ⁃ `{count}`" if count is not None else f"• {name}"
+        if count is not None and old_count is not None:
+            line += f" (`{count - old_count:+d}`)"
+        if amount is not None:
+            line += f" ⁃ {amount_md(amount)}"
+            if old_amount is not None:
+                line += f" (`{amount - old_amount:+,.2f}`)"
+        msg.append(line)
+    msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+    if daily:
+        msg.append("*⦗ End of day ⦘*")
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+        for day, sections in daily.items():
+            deposit = sections.get("Deposit", (None, None))[1]
+            pnl = sections.get("Affiliate Profit & Loss", (None, None))[1]
+            parts = [day.strftime("%a %d")]
+            if deposit is not None:
+                parts.append(f"Dep {amount_md(deposit)}")
+            if pnl is not None:
+                parts.append(f"P&L {amount_md(pnl)}")
+            msg.append("• " + " ⁃ ".join(parts))
+        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+
+    return "\n".join(msg)
+
+def load_trend(user_id, account, currency):
+    """Trend text for an account's currency from report history, or None without history"""
+    now_values = report_history.values_at(user_id, account, currency, time.time())
+    if now_values is None:
+        return None
+    yesterday_values = report_history.values_at(user_id, account, currency, now_values[0] - 86400)
+    daily = report_history.daily(user_id, account, currency, TREND_DAYS)
+    return format_trend(account, currency, now_values, yesterday_values, daily)
+
+# Background prefetch
+class PrefetchPlanner:
+    """Remembers when accounts get fetched and decides which ones to pre-scrape.
+
+    Each (user_id, account) keeps its last fetch time and a count of fetches per MYT
+    hour. An account is due when one of its usual hours (or a PREFETCH_HOURS hour)
+    starts within PREFETCH_LEAD_MINUTES, it has no fresh cached report, and it hasn't
+    been prefetched in the last hour.
+    """
+
+    def __init__(self, lookback_days, lead_minutes, fixed_hours, min_hits):
+        self.lookback = lookback_days * 86400
+        self.lead = lead_minutes * 60
+        self.fixed_hours = {int(h) for h in fixed_hours.split(",") if h.strip()}
+        self.min_hits = min_hits
+        self._usage = {}        # (user_id, account) -> {"last": ts, "hours": {hour: count}}
+        self._prefetched = {}   # (user_id, account) -> ts of last prefetch
+        self._lock = threading.Lock()
+
+    def record(self, user_id, account):
+        now = time.time()
+        hour = datetime.fromtimestamp(now, MYT).hour
+        with self._lock:
+            usage = self._usage.setdefault((user_id, account), {"last": now, "hours": {}})
+            usage["last"] = now
+            usage["hours"][hour] = usage["hours"].get(hour, 0) + 1
+
+    def forget(self, user_id, account):
+        with self._lock:
+            self._usage.pop((user_id, account), None)
+            self._prefetched.pop((user_id, account), None)
+
+    def due(self, now):
+        upcoming_hour = datetime.fromtimestamp(now + self.lead, MYT).hour
+        due = []
+        with self._lock:
+            for key, usage in list(self._usage.items()):
+                if now - usage["last"] > self.lookback:
+                    del self._usage[key]
+                    continue
+                hours = self.fixed_hours or {h for h, n in usage["hours"].items() if n >= self.min_hits}
+                if upcoming_hour not in hours:
+                    continue
+                if now - self._prefetched.get(key, 0) < 3600:
+                    continue
+                age = report_cache.age(*key)
+                if age is not None and age <= report_cache.ttl:
+                    continue
+                due.append(key)
+        return due
+
+    def mark_prefetched(self, user_id, account):
+        with self._lock:
+            self._prefetched[(user_id, account)] = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {"tracked_accounts": len(self._usage), "enabled": PREFETCH_ENABLED}
+
+prefetcher = PrefetchPlanner(PREFETCH_LOOKBACK_DAYS, PREFETCH_LEAD_MINUTES, PREFETCH_HOURS, PREFETCH_MIN_HITS)
+metrics.register_gauge("prefetch", prefetcher.stats)
+
+async def prefetch_account(user_id, account, budget):
+    """Scrape one account into the report cache, releasing a prefetch budget slot when done"""
+    try:
+        creds = await accounts_db.get_account_credentials(user_id, account)
+        if not creds:
+            prefetcher.forget(user_id, account)
+            return
+        job = scheduler.submit(("prefetch", user_id), scrape_data, creds['username'], creds['password'], user_id)
+        report_data = await job.future
+        if report_data:
+            report_cache.put(user_id, account, report_data)
+            metrics.incr("prefetch.scraped")
+        else:
+            metrics.incr("prefetch.failed")
+    except Exception as e:
+        logger.error(f"Prefetch of {account} failed: {str(e)}")
+    finally:
+        budget.release()
+
+async def prefetch_loop(application: Application):
+    """Periodically pre-scrape due accounts using only spare scrape capacity"""
+    budget = asyncio.Semaphore(PREFETCH_MAX_BROWSERS)
+    logger.info("Prefetch loop starting")
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        try:
+            for user_id, account in prefetcher.due(time.time()):
+                if not application.user_data.get(user_id, {}).get('prefetch', True):
+                    continue  # user opted out with /prefetch off
+                if scheduler.stats()["queued"]:
+                    break     # users are waiting; try again next pass
+                await budget.acquire()
+                try:
+                    # Spread our load on e2.partners instead of bursting at the top of the hour
+                    await asyncio.sleep(random.uniform(0, PREFETCH_JITTER))
+                    prefetcher.mark_prefetched(user_id, account)
+                    application.create_task(prefetch_account(user_id, account, budget))
+                except Exception:
+                    budget.release()  # prefetch_account() never started, so it won't release it
+                    raise
+        except Exception as e:
+            # One bad pass must not end prefetching for good
+            logger.error(f"Prefetch pass failed: {str(e)}")
+
+# Outbound Telegram requests
+class TokenBucket:
+    """`rate` tokens per second, bursting up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0, or the seconds to wait before trying again"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Give back a token that was taken but not used"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+class SendLimiter(BaseRateLimiter):
+    """Flood control for every Bot API call the bot makes (plugged in via the Application builder).
+
+    Requests to one chat go out one at a time, in order, within that chat's token bucket
+    (private and group chats have different limits); all chats share a global bucket.
+    A RetryAfter pauses everything for the time Telegram asks and the request is retried.
+    An edit that is still waiting when a newer edit of the same message arrives is
+    dropped and resolves with the newer edit's result.
+    """
+
+    UNLIMITED = {"answerCallbackQuery", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo"}
+    COALESCED = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+    def __init__(self, global_rate, chat_rate, chat_burst, group_rate, max_retries):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats = {}          # chat_id -> {"bucket", "lock", "used"}
+        self._latest_edit = {}    # (endpoint, chat_id, message_id) -> future of the newest edit
+        self._paused_until = 0.0
+        self._waiting = 0
+        self._last_sweep = time.monotonic()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self):
+        return {"queued": self._waiting, "chats": len(self._chats), "paused": self._paused_until > time.monotonic()}
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if group else self.chat_rate
+            chat = self._chats[chat_id] = {
+                "bucket": TokenBucket(rate, 1 if group else self.chat_burst),
+                "lock": asyncio.Lock(),
+            }
+        chat["used"] = time.monotonic()
+        return chat
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < 300:
+            return
+        self._last_sweep = now
+        for chat_id, chat in list(self._chats.items()):
+            if now - chat["used"] > 300 and not chat["lock"].locked():
+                del self._chats[chat_id]
+
+    async def _throttle(self, bucket, superseded=None) -> bool:
+        """Wait for a token of `bucket`; False (no token taken) as soon as `superseded()` is true"""
+        while True:
+            if superseded is not None and superseded():
+                return False
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = bucket.take()
+            if not delay:
+                return True
+            await asyncio.sleep(delay)
+
+    async def _send(self, callback, args, kwargs, chat, superseded=None):
+        """(result, False) once sent, or (None, True) if `superseded()` turned true while waiting"""
+        for attempt in range(self.max_retries + 1):
+            # Checked before each token is taken, so a dropped edit costs the chat nothing
+            if chat is not None and not await self._throttle(chat["bucket"], superseded):
+                return None, True
+            if not await self._throttle(self.global_bucket, superseded):
+                if chat is not None:
+                    chat["bucket"].refund()
+                return None, True
+            try:
+                return await callback(*args, **kwargs), False
+            except RetryAfter as e:
+                metrics.incr("telegram.retry_after")
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram flood control: pausing sends for {e.retry_after}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED:
+            return await callback(*args, **kwargs)
+
+        start = time.monotonic()
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        edit_key, future = None, None
+        if endpoint in self.COALESCED and chat_id is not None and data.get("message_id") is not None:
+            edit_key = (endpoint, chat_id, data["message_id"])
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self._latest_edit[edit_key] = future
+
+        def superseded():
+            return self._latest_edit.get(edit_key) is not future
+
+        self._waiting += 1
+        try:
+            if chat_id is None:
+                result, _ = await self._send(callback, args, kwargs, None)
+            else:
+                chat = self._chat(chat_id)
+                newest = None
+                async with chat["lock"]:
+                    result, dropped = await self._send(callback, args, kwargs, chat, superseded if edit_key else None)
+                    if dropped:
+                        newest = self._latest_edit[edit_key]
+                if newest is not None:
+                    # A newer edit of this message is queued behind us and carries our change too
+                    metrics.incr("telegram.edits_coalesced")
+                    result = await asyncio.shield(newest)
+            if future is not None and not future.done():
+                future.set_result(result)
+            return result
+        except Exception as e:
+            if future is not None and not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self._waiting -= 1
+            if edit_key and self._latest_edit.get(edit_key) is future:
+                del self._latest_edit[edit_key]
+            metrics.observe("telegram.send", time.monotonic() - start)
+            self._sweep()
+
+send_limiter = SendLimiter(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_GROUP_RATE, TG_MAX_RETRIES)
+metrics.register_gauge("telegram", send_limiter.stats)
+
+# Update processing
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to `max_concurrent_updates` updates at once, but a user's messages one at a time
+
+    Messages drive the /addaff and /remove conversations, so each user's (or chat's,
+    when there is no user) wait for each other in arrival order and steps like
+    USERNAME -> PASSWORD never race. Button presses don't take the turn: a long
+    fetch must not hold up the same user's navigation, /accounts or /cancel.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # key -> [asyncio.Lock, updates holding or waiting for it]
+        self._running = 0
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update) and update.effective_message and not update.callback_query:
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+            if update.effective_chat:
+                return ("chat", update.effective_chat.id)
+        return None
 
-def scrape_single_currency(driver):
-    """Scrape data for the current currency"""
-    # Helper function to extract amount and detect negative (red color)
-    def extract_amount(cell):
+    async def process_update(self, update, coroutine):
+        # The user's turn comes first and only then a global slot (taken by the base
+        # class), so a user's queued updates never hold slots other users could use
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        queued = time.monotonic()
         try:
-            # Look for <span> elements with red color styling
-            red_spans = cell.find_elements(
-                By.XPATH, ".//span[contains(@style, 'color:red') or contains(@style, 'color: red')]"
-            )
-            if red_spans:
-                amount_text = red_spans[0].text.strip()
-                # Add minus sign directly to amount without space
-                if amount_text and not amount_text.startswith('-'):
-                    return '-' + amount_text.replace(" ", "")
-                return amount_text.replace(" ", "")
-            return cell.text.strip().replace(" ", "")
-        except:
-            return cell.text.strip().replace(" ", "")
+            async with entry[0]:
+                metrics.observe("update.user_wait", time.monotonic() - queued)
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
 
-    try:
-        # Step 3: Scrape Active Players
-        active_players = {}
+    async def do_process_update(self, update, coroutine):
+        self._running += 1
         try:
-            this_period = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "thisPeriodActivePlayer"))
-            ).text
-            last_period = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "lastPeriodActivePlayer"))
-            ).text
-            active_players = {
-                "this_period": this_period,
-                "last_period": last_period
-            }
-        except Exception as e:
-            logger.warning(f"Could not scrape active players: {str(e)}")
+            await coroutine
+        finally:
+            self._running -= 1
 
-        commissions = {}
-        try:
-            this_period_commission = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "thisPeriodCommission"))
-            ).text
-            last_period_commission = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, "lastPeriodCommission"))
-            ).text
-
-            # Extract currency symbol from commission values
-            currency = ''
-            if this_period_commission and this_period_commission[0] in '$€£¥₩₹₽₿₺₴₸₲₵₡₪₫':
-                currency = this_period_commission[0]
-
-            commissions = {
-                "this_period": this_period_commission,
-                "last_period": last_period_commission,
-                "currency": currency
-            }
-        except Exception as e:
-            logger.warning(f"Could not scrape commissions: {str(e)}")
+    async def initialize(self):
+        pass
 
-        # New: Scrape Withdrawable Amount
-        withdrawable = ""
-        try:
-            # Wait for user info element
-            user_info = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.CLASS_NAME, "user-info"))
-            )
+    async def shutdown(self):
+        pass
 
-            # Extract money elements
-            money_element = user_info.find_element(By.CLASS_NAME, "money")
-            symbol = money_element.find_element(By.ID, "navBarMoney").text.strip()
-            amount = money_element.find_element(By.ID, "navBarAvailable").text.strip()
+    def stats(self):
+        return {"limit": self.max_concurrent_updates, "running": self._running, "users": len(self._locks)}
 
-            withdrawable = f"`{symbol}` `{amount}`"
-        except Exception as e:
-            logger.warning(f"Could not scrape withdrawable amount: {str(e)}")
-
-        # Step 4: Scrape sections using multiple identification methods
-        report_data = {}
-        section_selectors = {
-            "Registered Users": {
-                "title": "Registered Users",
-                "container": "div:nth-child(5)"  # Adjust based on screenshot
-            },
-            "First Deposit": {
-                "title": "First Deposit",
-                "container": "div:nth-child(3) > div:nth-child(3)"  # Adjust based on screenshot
-            },
-            "Deposit": {
-                "title": "Deposit",
-                "container": "div:nth-child(4) > div:nth-child(1)"  # Adjust based on screenshot
-            },
-            "Withdrawal": {
-                "title": "Withdrawal",
-                "container": "div:nth-child(4) > div:nth-child(2)"  # Adjust based on screenshot
-            },
-            "Affiliate Profit & Loss": {
-                "title": "Affiliate Profit & Loss",
-                "container": "div:nth-child(7)"  # Adjust based on screenshot
-            },
-            "Turnover": {
-                "title": "Turnover",
-                "container": "div:nth-child(6) > div:nth-child(2)"  # Adjust based on screenshot
-            }
-        }
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY)
+metrics.register_gauge("updates", update_processor.stats)
 
-        for section_name, selector in section_selectors.items():
-            try:
-                # Try multiple methods to find the section
-                section = None
+# Bot state persistence
+class SQLitePersistence(BasePersistence):
+    """user_data and conversation states in a local SQLite file, so a restart loses neither.
 
-                # Method 1: By exact title text
-                try:
-                    section = driver.find_element(
-                        By.XPATH,
-                        f"//h2[normalize-space()='{selector['title']}']/ancestor::div[contains(@class, 'panel')]"
-                    )
-                except NoSuchElementException:
-                    pass
+    One row per user / conversation key, JSON encoded. PTB hands over only what
+    changed since the last flush (every STATE_FLUSH_INTERVAL seconds, and on
+    shutdown), and each of those is a single upsert. Rows not updated within
+    their TTL are deleted when the state is loaded and then every hour.
+    """
 
-                # Method 2: By container position (CSS selector)
-                if not section:
-                    try:
-                        section = driver.find_element(
-                            By.CSS_SELECTOR,
-                            f"div.panel > {selector['container']}"
-                        )
-                    except NoSuchElementException:
-                        pass
-
-                # Method 3: Fallback to general panel search
-                if not section:
-                    panels = driver.find_elements(By.CLASS_NAME, "panel")
-                    for panel in panels:
-                        if selector['title'] in panel.text:
-                            section = panel
-                            break
-
-                if not section:
-                    logger.warning(f"Section not found: {section_name}")
-                    continue
+    PRUNE_INTERVAL = 3600
 
-                # Extract table data
-                table = section.find_element(By.TAG_NAME, "table")
-                headers = [th.text.strip() for th in table.find_elements(By.TAG_NAME, "th")]
-
-                rows = []
-                period_mapping = {
-                    "Today": "Today",
-                    "Yesterday": "Yesterday",
-                    "This Week": "This Week",
-                    "This Month": "This Month",
-                    "Last Month": "Last Month"
-                }
+    def __init__(self, path, flush_interval, user_ttl, conversation_ttl):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.path = path
+        self.user_ttl = user_ttl
+        self.conversation_ttl = conversation_ttl
+        self._conn = None
+        self._last_prune = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-db")
 
-                # Special handling for Turnover section
-                if section_name == "Turnover":
-                    period_mapping = {
-                        "This Month": "This Month",
-                        "Last Month": "Last Month"
-                    }
-
-                # Pull every row
-                if section_name == "Registered Users":
-                    for tr in table.find_elements(By.TAG_NAME, "tr")[1:]:
-                        cells = tr.find_elements(By.TAG_NAME, "td")
-                        if len(cells) < 2:
-                            continue
-
-                        period = cells[0].text.strip()
-                        period = period_mapping.get(period, period)
-
-                        if period in period_mapping.values():
-                            count = cells[1].text.strip()
-                            rows.append([period, count])
-                else:
-                    for tr in table.find_elements(By.TAG_NAME, "tr")[1:]:
-                        cells = tr.find_elements(By.TAG_NAME, "td")
-                        if len(cells) < 3:
-                            continue
-
-                        period = cells[0].text.strip()
-                        period = period_mapping.get(period, period)
-                        if period not in period_mapping.values():
-                            continue
-
-                        count = cells[1].text.strip()
-                        
-                        # ONLY apply negative handling to Profit & Loss section
-                        if section_name == "Affiliate Profit & Loss":
-                            amount_str = extract_amount(cells[2])
-                        else:
-                            amount_str = cells[2].text.strip()
-
-                        # Process currency symbol
-                        CURRENCY_SYMBOLS = '$€£¥₩₹₽₿₺₴₸₲₵₡₪₫'
-                        currency_sym = ''
-                        
-                        # Handle negative amounts with currency symbol
-                        if amount_str.startswith('-') and len(amount_str) > 1:
-                            # Check for currency symbol at position 1 (after minus)
-                            if amount_str[1] in CURRENCY_SYMBOLS:
-                                currency_sym = amount_str[1]
-                                amount_str = '-' + amount_str[2:].strip()
-                            else:
-                                # Keep minus sign and continue processing
-                                amount_str = amount_str.strip()
-                        # Handle positive amounts with currency symbol
-                        elif amount_str and amount_str[0] in CURRENCY_SYMBOLS:
-                            currency_sym = amount_str[0]
-                            amount_str = amount_str[1:].strip()
-
-                        rows.append([period, count, amount_str, currency_sym])
-
-                if rows:
-                    report_data[section_name] = {
-                        "headers": headers,
-                        "rows": rows,
-                        "currency": commissions.get("currency", "")
-                    }
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS user_data(
+                                user_id INTEGER PRIMARY KEY,
+                                data TEXT NOT NULL,
+                                updated INTEGER NOT NULL
+                            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS conversations(
+                                name TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                state TEXT NOT NULL,
+                                updated INTEGER NOT NULL,
+                                PRIMARY KEY (name, key)
+                            )""")
+            conn.commit()
+            self._conn = conn
+        return self._conn
 
-            except Exception as e:
-                logger.error(f"Error processing section {section_name}: {str(e)}")
-                continue
+    async def _run(self, func, *args):
+        return await run_blocking(self._executor, func, *args)
 
-        return {
-            "active_players": active_players,
-            "commissions": commissions,
-            "sections": report_data,
-            "withdrawable": withdrawable
-        }
-    except Exception as e:
-        logger.error(f"Scraping failed: {str(e)}")
-        return None
+    def _prune(self):
+        now = int(time.time())
+        conn = self._db()
+        users = conn.execute("DELETE FROM user_data WHERE updated < ?", (now - self.user_ttl,)).rowcount
+        convs = conn.execute("DELETE FROM conversations WHERE updated < ?", (now - self.conversation_ttl,)).rowcount
+        conn.commit()
+        self._last_prune = now
+        if users or convs:
+            logger.info(f"Pruned persisted state: {users} users, {convs} conversations")
 
-def scrape_data(username: str, password: str, user_id: int):
-    """Scrape data for all available currencies"""
-    # Create driver instance
-    driver = create_driver()
-    if not driver:
-        return None
-        
-    try:
-        # Step 1: Login
-        driver.delete_all_cookies()
-        driver.get(LOGIN_URL)
-        time.sleep(1)
-        
-        # Fill credentials
-        username_field = WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.NAME, "userId"))
-        )
-        username_field.send_keys(username)
-        
-        
-        password_field = WebDriverWait(driver, 15).until(
-            EC.presence_of_element_located((By.NAME, "password"))
-        )
-        password_field.send_keys(password)
-        
-        
-        # Click login button
-        login_button = WebDriverWait(driver, 15).until(
-            EC.element_to_be_clickable((By.ID, "login"))
-        )
-        login_button.click()
-        
-        # Step 2: Wait for dashboard
-        WebDriverWait(driver, 20).until(
-            EC.url_contains("index.jsp")
-        )
-        
-        # Wait for critical elements to load
-        WebDriverWait(driver, 20).until(
-            EC.presence_of_element_located((By.CLASS_NAME, "panel"))
+    def _write(self, sql, params):
+        conn = self._db()
+        conn.execute(sql, params)
+        conn.commit()
+        metrics.incr("state.writes")
+        if time.time() - self._last_prune >= self.PRUNE_INTERVAL:
+            self._prune()
+
+    def _load_user_data(self):
+        self._prune()
+        rows = self._db().execute("SELECT user_id, data FROM user_data").fetchall()
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def _load_conversations(self, name):
+        self._prune()
+        rows = self._db().execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_user_data(self):
+        data = await self._run(self._load_user_data)
+        logger.info(f"Restored user_data of {len(data)} users")
+        return data
+
+    async def get_conversations(self, name):
+        return await self._run(self._load_conversations, name)
+
+    async def update_user_data(self, user_id, data):
+        if not data:
+            await self.drop_user_data(user_id)
+            return
+        try:
+            encoded = json.dumps(data)
+        except TypeError as e:
+            logger.error(f"Not persisting user_data of {user_id}: {e}")
+            return
+        await self._run(
+            self._write,
+            "INSERT INTO user_data(user_id, data, updated) VALUES(?,?,?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+            (user_id, encoded, int(time.time())),
         )
-        
-        # Get available currencies
-        currencies = get_available_currencies(driver)
-        if not currencies:
-            logger.info("No currencies found, scraping default")
-            return {'DEFAULT': scrape_single_currency(driver)}
-        
-        # Scrape data for each currency
-        currency_reports = {}
-        for currency in currencies:
-            logger.info(f"Scraping for currency: {currency['text']}")
-            
-            # Change currency
-            if change_currency(driver, currency['value']):
-                # Scrape data for this currency
-                report = scrape_single_currency(driver)
-                if report:
-                    currency_reports[currency['text']] = report
-            else:
-                logger.error(f"Failed to change to currency: {currency['text']}")
-        
-        return currency_reports
-        
-    except Exception as e:
-        logger.error(f"Scraping failed: {str(e)}")
-        return None
-    finally:
-        if driver:
-            driver.quit()
 
-def format_report(data, account_name: str = "", currency: str = "", last_update: datetime = None):
-    """Format report in Markdown for Telegram (parse_mode='Markdown')."""
-    if not data:
-        return "_No data available. Please try again later._"
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None or new_state == ConversationHandler.END:
+            await self._run(self._write, "DELETE FROM conversations WHERE name = ? AND key = ?",
+                            (name, json.dumps(list(key))))
+            return
+        await self._run(
+            self._write,
+            "INSERT INTO conversations(name, key, state, updated) VALUES(?,?,?,?) "
+            "ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+            (name, json.dumps(list(key)), json.dumps(new_state), int(time.time())),
+        )
 
-    current_myt = get_malaysia_time()
-    
-    # Handle the last_update parameter correctly
-    if last_update is None:
-        # Use current MYT time if no last_update provided
-        report_time = current_myt
-    else:
-        # Convert any datetime to MYT
-        if last_update.tzinfo is None:
-            # If naive datetime, assume UTC
-            report_time = last_update.replace(tzinfo=timezone.utc).astimezone(MYT)
-        else:
-            # Convert to MYT if it has timezone info
-            report_time = last_update.astimezone(MYT)
+    async def drop_user_data(self, user_id):
+        await self._run(self._write, "DELETE FROM user_data WHERE user_id = ?", (user_id,))
 
-    # Format the header date
-    current_date = report_time.strftime("%a, %B %d")
-    total_width = 65  # tweak to align the date
-    
-    # Add currency to account name if provided
-    display_name = f"⟪ {account_name} ⟫ ({currency})" if currency else account_name
-    padding = max(total_width - len(display_name) - len(current_date), 1)
-    header = f"*{display_name}{' ' * padding}{current_date}*\n"
+    async def refresh_user_data(self, user_id, user_data):
+        pass
 
-    msg = [header]
+    async def flush(self):
+        await self._run(self._prune)
 
-    if withdrawable := data.get("withdrawable"):
-        msg.append(f"*Withdrawable:* {withdrawable}")
+    # chat_data, bot_data and callback_data aren't stored (see store_data)
+    async def get_chat_data(self):
+        return {}
 
-    # Initialize variables to avoid reference before assignment
-    ap = data.get("active_players", {})
-    comm = data.get("commissions", {})
-    
-    # Active Players and Commissions side by side
-    if ap or comm:
-        # Section headers
-        active_header = "⦗ Active Players ⦘"
-        comm_header = "⦗ Commissions ⦘"
-        padding = 30 - len(active_header)  # Adjust spacing between columns
-        section_headers = f"*{active_header}{' ' * padding}{comm_header}*"
-        msg.append(section_headers)
-        
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    async def get_bot_data(self):
+        return {}
 
-        # This Period row
-        ap_this = ap.get("this_period", "N/A")
-        comm_this = comm.get("this_period", "N/A")
-        comm_this_clean = comm_this.strip()
-        if comm_this_clean and not comm_this_clean[0].isdigit():
-            # Find where numbers start in the string
-            for i, char in enumerate(comm_this_clean):
-                if char.isdigit() or char in '.,-':
-                    currency_part = comm_this_clean[:i].strip()
-                    amount_part = comm_this_clean[i:].strip()
-                    comm_this = f"{currency_part} {amount_part}"
-                    break
-        
-        left_part = f"This Period *≅* `{ap_this}`"
-        padding = 30 - len(left_part)
-        right_part = f"This Period - `{comm_this}`"
-        msg.append(f"{left_part}{' ' * padding}{right_part}")
-
-        # Last Period row
-        ap_last = ap.get("last_period", "N/A")
-        comm_last = comm.get("last_period", "N/A")
-        
-        # Apply the same cleaning to last period
-        comm_last_clean = comm_last.strip()
-        if comm_last_clean and not comm_last_clean[0].isdigit():
-            for i, char in enumerate(comm_last_clean):
-                if char.isdigit() or char in '.,-':
-                    currency_part = comm_last_clean[:i].strip()
-                    amount_part = comm_last_clean[i:].strip()
-                    comm_last = f"{currency_part} {amount_part}"
-                    break
-        
-        left_part = f"Last Period *≅* `{ap_last}`"
-        padding = 30 - len(left_part)
-        right_part = f"Last Period - `{comm_last}`"
-        msg.append(f"{left_part}{' ' * padding}{right_part}")
+    async def get_callback_data(self):
+        return None
 
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    async def update_chat_data(self, chat_id, data):
+        pass
 
-    if "Registered Users" in data.get("sections", {}):
-        ru_section = data["sections"]["Registered Users"]
-        rows = ru_section.get("rows", [])
-        
-        msg.append("*⦗ Registered Users ⦘*")
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
-        
-        for row in rows:
-            if len(row) >= 2:
-                period, count = row[0], row[1]
-                line = f"• {period} ⁃ `{count}`"
-                msg.append(line)
-        
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    async def update_bot_data(self, data):
+        pass
 
-    # Other sections
-    sections = [
-        ("First Deposit", "|", True),
-        ("Deposit", "|", True),
-        ("Withdrawal", "|", True),
-        ("Affiliate Profit & Loss", "=", False),
-        ("Turnover", "=", False),
-    ]
+    async def update_callback_data(self, data):
+        pass
 
-    for name, sep, parens in sections:
-        if name not in data.get("sections", {}):
-            continue
+    async def drop_chat_data(self, chat_id):
+        pass
 
-        section_data = data["sections"][name]
-        rows = section_data.get("rows", [])
-        currency_sym = section_data.get("currency", "")
-        
-        msg.append(f"*⦗ {name} ⦘*")
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-        for row in rows:
-            if len(row) >= 4:  # period, count, amount, currency
-                period, count, amount, row_currency = row[0], row[1], row[2], row[3]
-                effective_currency = row_currency if row_currency else currency_sym
-            else:
-                period, count, amount = row[0], row[1], row[2]
-                effective_currency = currency_sym
-
-            count_md = f"`{count}`"
-
-            # Special handling for Profit & Loss negative amounts
-            if name == "Affiliate Profit & Loss":
-                # Format negative amounts without space after minus sign
-                if amount.startswith('-') and len(amount) > 1:
-                    # Remove any existing spaces and format as '-123.45'
-                    cleaned_amount = amount.replace(" ", "")
-                    amt_md = f"`{cleaned_amount}`"
-                else:
-                    amt_md = f"`{amount}`"
-            else:
-                # For other sections, format with currency symbol
-                if effective_currency:
-                    amt_md = f"`{effective_currency} {amount}`"
-                else:
-                    amt_md = f"`{amount}`"
+    async def refresh_bot_data(self, bot_data):
+        pass
 
-            if parens:
-                line = f"• {period} {sep} {count_md} {sep} ( {amt_md} )"
-            else:
-                line = f"• {period} {sep} {amt_md}"
+persistence = (
+    SQLitePersistence(STATE_DB, STATE_FLUSH_INTERVAL, USER_DATA_TTL_DAYS * 86400, CONVERSATION_TTL)
+    if PERSIST_STATE else None
+)
 
-            msg.append(line)
+# Webhook mode
+class TelegramWebhook:
+    """Feeds updates POSTed to /telegram/webhook into the application's update queue
 
-        msg.append("*━━━━━━━━━━━━━━━━━━━━*")
+    Flask serves requests on its own threads, so updates are handed to the bot's
+    event loop with run_coroutine_threadsafe. Until attach() is called (polling
+    mode, or still starting up) every delivery gets a 503 and Telegram retries it.
+    """
 
-    # Footer (italic)
+    HEADER = "X-Telegram-Bot-Api-Secret-Token"
 
-        # Footer (italic)
-    timestamp = report_time.strftime("%Y-%m-%d %H:%M:%S (MYT)")
-    msg.append(f"_Last updated: {timestamp}_")
+    def __init__(self, secret, queue_timeout, remember=1000):
+        self.secret = secret
+        self.queue_timeout = queue_timeout
+        self.application = None
+        self.loop = None
+        self._seen = OrderedDict()  # recent update_ids, so redeliveries aren't handled twice
+        self._remember = remember
+        self._lock = threading.Lock()
 
-    return "\n".join(msg)
+    def attach(self, application, loop):
+        self.application = application
+        self.loop = loop
 
+    def detach(self):
+        self.application = None
+        self.loop = None
 
-# Database functions
-def addaffiliate_account(user_id: int, username: str, password: str):
-    """Add affiliate account to database"""
-    try:
-        response = supabase_client.table('affiliate_accounts').insert({
-            'user_id': user_id,
-            'username': username,
-            'password': password
-        }).execute()
-        
-        if response.data:
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Database error: {str(e)}")
-        return False
-# Add this in the "Database functions" section
-def remove_account_from_db(user_id: int, username: str) -> bool:
-    """Remove affiliate account from database"""
-    try:
-        response = supabase_client.table('affiliate_accounts').delete().eq('user_id', user_id).eq('username', username).execute()
-        # Check if any rows were deleted
-        if response.data and len(response.data) > 0:
+    def _first_delivery(self, update_id):
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = None
+            if len(self._seen) > self._remember:
+                self._seen.popitem(last=False)
             return True
-        return False
-    except Exception as e:
-        logger.error(f"Database error: {str(e)}")
-        return False
 
-def get_user_accounts(user_id: int):
-    """Get all affiliate accounts for a user"""
-    try:
-        response = supabase_client.table('affiliate_accounts').select(
-            "username"
-        ).eq('user_id', user_id).execute()
-        
-        return [account['username'] for account in response.data] if response.data else []
-    except Exception as e:
-        logger.error(f"Database error: {str(e)}")
-        return []
+    def receive(self, req):
+        application, loop = self.application, self.loop
+        if application is None:
+            return Response("Not accepting updates", status=503)
+        token = req.headers.get(self.HEADER, "")
+        if not self.secret or not hmac.compare_digest(token.encode(), self.secret.encode()):
+            metrics.incr("webhook.rejected")
+            return Response("Forbidden", status=403)
+        data = req.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return Response("Bad update", status=400)
+        if not self._first_delivery(data["update_id"]):
+            metrics.incr("webhook.duplicates")
+            return Response(status=200)
+        try:
+            update = Update.de_json(data, application.bot)
+            asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop).result(self.queue_timeout)
+        except Exception as e:
+            logger.error(f"Could not queue webhook update {data['update_id']}: {e}")
+            with self._lock:
+                self._seen.pop(data["update_id"], None)  # let Telegram's retry through
+            return Response("Not accepting updates", status=503)
+        metrics.incr("webhook.updates")
+        return Response(status=200)
 
-def get_account_credentials(user_id: int, username: str):
-    """Get credentials for a specific account"""
-    try:
-        response = supabase_client.table('affiliate_accounts').select(
-            "username", "password"
-        ).eq('user_id', user_id).eq('username', username).execute()
-        
-        if response.data:
-            return response.data[0]
-        return None
-    except Exception as e:
-        logger.error(f"Database error: {str(e)}")
-        return None
+webhook = TelegramWebhook(WEBHOOK_SECRET, WEBHOOK_QUEUE_TIMEOUT)
+
+async def run_webhook(application):
+    """Process updates delivered to /telegram/webhook until SIGINT/SIGTERM
+
+    Every replica registers the same URL and secret, so any of them can sit behind
+    the load balancer; the webhook is left in place on shutdown for the others.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when WEBHOOK_URL is")
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        webhook.attach(application, loop)
+        logger.info(f"Receiving updates by webhook at {WEBHOOK_URL}")
+        try:
+            await stop.wait()
+        finally:
+            webhook.detach()
+            await application.stop()
 
 # Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -927,6 +3785,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "*• /remove - remove a connected account*\n"
         "*• /fetch - fetch reports for your accounts*\n"
         "*• /accounts - list your saved accounts*\n"
+        "*• /prefetch - turn background prefetch on/off*\n"
         "*• /help - usage documentation*\n"
         "*• /report - report bugs & errors*\n"
     )
@@ -946,6 +3805,17 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+async def prefetch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turn background prefetching of the user's accounts on or off"""
+    if context.args and context.args[0].lower() in ("on", "off"):
+        context.user_data['prefetch'] = context.args[0].lower() == "on"
+
+    if context.user_data.get('prefetch', True):
+        text = "*Background prefetch is on.*\n*Send `/prefetch off` to stop it.*"
+    else:
+        text = "*Background prefetch is off.*\n*Send `/prefetch on` to turn it back on.*"
+    await update.message.reply_text(text, parse_mode="Markdown")
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user reports"""
     await update.message.reply_text(
@@ -978,7 +3848,7 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['user_id'] = user_id  # Store for cancellation
     
     # Cooldown check
-    if USER_BUSY.get(user_id, False):
+    if scheduler.is_busy(user_id):
         await update.message.reply_text(
             "*Processing your previous request...*\n"
             "Use /cancel to abort current request",
@@ -986,18 +3856,19 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Set busy state
-    USER_BUSY[user_id] = True
-    
     try:
         password = update.message.text
         username = context.user_data['username']
         
         # Validate credentials
-        await update.message.reply_text("*Validating credentials... (ETA≈ 7-12s)*", parse_mode="Markdown")
-        if validate_credentials(username, password):
+        job = scheduler.submit(user_id, validate_credentials, username, password)
+        if job.position:
+            await update.message.reply_text(f"*Validating credentials...{queue_note(job)}*", parse_mode="Markdown")
+        else:
+            await update.message.reply_text("*Validating credentials... (ETA≈ 7-12s)*", parse_mode="Markdown")
+        if await job.future:
             # Save to database
-            if addaffiliate_account(user_id, username, password):
+            if await accounts_db.add_account(user_id, username, password):
                 await update.message.reply_text(
                     f"*Account Added Successfully!*\n"
                     f"*E2 Affiliate `{username}` has been added to your account.*",
@@ -1018,9 +3889,9 @@ async def handle_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in handle_password: {str(e)}")
     finally:
-        # Clear busy state
-        USER_BUSY[user_id] = False
-        context.user_data.clear()
+        # Only the conversation's own keys: the rest of user_data (preferences) is persisted
+        context.user_data.pop('username', None)
+        context.user_data.pop('user_id', None)
         return ConversationHandler.END
 # Add these new handlers in the "Command handlers" section
 async def remove_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1031,7 +3902,7 @@ async def remove_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if args:
         # Direct removal via /remove username
         username = args[0]
-        if remove_account_from_db(user_id, username):
+        if await accounts_db.remove_account(user_id, username):
             await update.message.reply_text(f"Removed `{username}`.", parse_mode="Markdown")
         else:
             await update.message.reply_text(f"`{username}` is not connected.", parse_mode="Markdown")
@@ -1048,7 +3919,7 @@ async def handle_remove_username(update: Update, context: ContextTypes.DEFAULT_T
     user_id = update.message.from_user.id
     username = update.message.text
     
-    if remove_account_from_db(user_id, username):
+    if await accounts_db.remove_account(user_id, username):
         await update.message.reply_text(f"Removed `{username}`.", parse_mode="Markdown")
     else:
         await update.message.reply_text(f"`{username}` is not connected.", parse_mode="Markdown")
@@ -1077,14 +3948,14 @@ async def fetch_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Fetch reports with account selection menu"""
     user_id = update.message.from_user.id
     
-    if USER_BUSY.get(user_id, False):
+    if scheduler.is_busy(user_id):
         await update.message.reply_text(
             "*Processing your previous request...*",
             parse_mode="Markdown"
         )
         return
     
-    accounts = get_user_accounts(user_id)
+    accounts = await accounts_db.get_user_accounts(user_id)
     
     if not accounts:
         await update.message.reply_text(
@@ -1112,128 +3983,101 @@ async def fetch_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def fetch_account_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle account selection for fetching reports with proper data storage"""
     query = update.callback_query
+    started = time.monotonic()
     await query.answer()
     user_id = query.from_user.id
     
-    # Set busy state
-    USER_BUSY[user_id] = True
-    
     try:
         data = query.data
         
         if data == "fetch_all":
-            accounts = get_user_accounts(user_id)
+            # One query for every account's credentials
+            all_creds = await accounts_db.get_user_credentials(user_id)
             message = await query.message.reply_text("*Gathering reports for all accounts...(ETA≈ 8-15s)*", parse_mode="Markdown")
+            chat_id = query.message.chat_id
             
-            # Initialize reports storage
-            context.user_data.setdefault('reports', {})
-            
-            for account in accounts:
-                creds = get_account_credentials(user_id, account)
-                if not creds:
+            # Cached accounts are posted right away; the rest are scraped together and
+            # posted in the order they finish
+            streams = []
+            for creds in all_creds:
+                account = creds['username']
+                prefetcher.record(user_id, account)
+                cached = await cached_report(user_id, account)
+                if not cached:
+                    streams.append((account, ReportStream(
+                        user_id, creds['username'], creds['password'], user_id, preferred_currency(context, account)
+                    )))
                     continue
-                    
-                report_data = scrape_data(
-                    creds['username'], 
-                    creds['password'], 
-                    user_id
+
+                report_data, fetched_at, fresh = cached
+                # Store report for navigation
+                remember_report(user_id, account, report_data, fetched_at)
+                report, reply_markup = report_store.render(user_id, account)
+                sent = await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=report,
+                    parse_mode="Markdown",
+                    reply_markup=reply_markup
                 )
-                
-                if report_data:
-                    # Store report for navigation
-                    context.user_data['reports'][account] = report_data
-                    
-                    if isinstance(report_data, dict) and len(report_data) > 0:
-                        first_currency = next(iter(report_data.keys()))
-                        report = format_report(report_data[first_currency], account, first_currency, last_update=query.message.date)
-                        
-                        if len(report_data) > 1:
-                            keyboard = [
-                                [
-                                    InlineKeyboardButton("❮❮❮", callback_data=f"nav:{account}:{first_currency}:prev"),
-                                    InlineKeyboardButton(first_currency, callback_data="none"),
-                                    InlineKeyboardButton("❯❯❯", callback_data=f"nav:{account}:{first_currency}:next")
-                                ]
-                            ]
-                            reply_markup = InlineKeyboardMarkup(keyboard)
-                            await context.bot.send_message(
-                                chat_id=query.message.chat_id,
-                                text=report,
-                                parse_mode="Markdown",
-                                reply_markup=reply_markup
-                            )
-                        else:
-                            await context.bot.send_message(
-                                chat_id=query.message.chat_id,
-                                text=report,
-                                parse_mode="Markdown"
-                            )
-                    else:
-                        report = format_report(report_data, account, last_update=query.message.date)
-                        await context.bot.send_message(
-                            chat_id=query.message.chat_id,
-                            text=report,
-                            parse_mode="Markdown"
-                        )
-                else:
-                    await context.bot.send_message(
-                        chat_id=query.message.chat_id,
-                        text=f"*Failed to fetch data for account `{account}`*",
-                        parse_mode="Markdown"
-                    )
+                if not fresh:
+                    schedule_refresh(context, user_id, account, sent.chat_id, sent.message_id)
+
+            waiting = [stream.job for _, stream in streams if stream.job.position]
+            if waiting:
+                await message.edit_text(
+                    f"*Gathering reports for all accounts...{queue_note(min(waiting, key=lambda job: job.position))}*",
+                    parse_mode="Markdown"
+                )
+            await asyncio.gather(*(
+                post_account_report(context, stream, user_id, account, chat_id, started)
+                for account, stream in streams
+            ))
             
             await message.delete()
             
-        elif data.startswith("fetch_"):
-            account = data.replace("fetch_", "")
-            creds = get_account_credentials(user_id, account)
+        elif data.startswith(("fetch_", "refresh_")):
+            # refresh_<account> skips the cache
+            force = data.startswith("refresh_")
+            account = data.split("_", 1)[1]
+            prefetcher.record(user_id, account)
+
+            cached = None if force else await cached_report(user_id, account)
+            if cached:
+                report_data, fetched_at, fresh = cached
+                remember_report(user_id, account, report_data, fetched_at)
+                report, reply_markup = report_store.render(user_id, account)
+                await query.edit_message_text(text=report, parse_mode="Markdown", reply_markup=reply_markup)
+                if not fresh:
+                    schedule_refresh(context, user_id, account, query.message.chat_id, query.message.message_id)
+                return
+
+            creds = await accounts_db.get_account_credentials(user_id, account)
             
             if not creds:
                 await query.edit_message_text(f"*Account `{account}` not found*", parse_mode="Markdown")
                 return
             
-            await query.edit_message_text(f"*Fetching {account}...(ETA≈ 8-12s)*", parse_mode="Markdown")
-            report_data = scrape_data(
-                creds['username'], 
-                creds['password'], 
-                user_id
+            stream = ReportStream(
+                user_id, creds['username'], creds['password'], user_id, preferred_currency(context, account)
+            )
+            job = stream.job
+            if job.position:
+                await query.edit_message_text(f"*Fetching {account}...{queue_note(job)}*", parse_mode="Markdown")
+            else:
+                await query.edit_message_text(f"*Fetching {account}...(ETA≈ 8-12s)*", parse_mode="Markdown")
+
+            # The first currency replaces the status message as soon as it's scraped
+            report_data, fetched_at = await stream_report(
+                context, stream, user_id, account, started,
+                lambda text, markup: query.edit_message_text(text=text, parse_mode="Markdown", reply_markup=markup)
             )
             
             if report_data:
-                # Store report for navigation
-                context.user_data.setdefault('reports', {})
-                context.user_data['reports'][account] = report_data
-                
-                currencies = list(report_data.keys())
-                current_currency = currencies[0]
-                report = format_report(report_data[current_currency], account, current_currency, last_update=query.message.date)
-                
-                if len(currencies) > 1:
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("❮❮❮", callback_data=f"nav:{account}:{current_currency}:prev"),
-                            InlineKeyboardButton(current_currency, callback_data="none"),
-                            InlineKeyboardButton("❯❯❯", callback_data=f"nav:{account}:{current_currency}:next")
-                        ]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await query.edit_message_text(
-                        text=report,
-                        parse_mode="Markdown",
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await query.edit_message_text(
-                        text=report,
-                        parse_mode="Markdown"
-                    )
+                report_cache.put(user_id, account, report_data, fetched_at)
             else:
                 await query.edit_message_text(f"*Failed to fetch {account}*", parse_mode="Markdown")
     except Exception as e:
         logger.error(f"Error in fetch_account_report: {str(e)}")
-    finally:
-        # Clear busy state
-        USER_BUSY[user_id] = False
 
 async def handle_currency_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle currency navigation with persistent data"""
@@ -1245,17 +4089,16 @@ async def handle_currency_navigation(update: Update, context: ContextTypes.DEFAU
     current_currency = parts[2]
     direction = parts[3]
     
-    # Retrieve stored reports
-    reports = context.user_data.get('reports', {})
-    
-    if not reports:
-        await query.edit_message_text(
-            "*No reports available. Please fetch reports again.*",
-            parse_mode="Markdown"
-        )
-        return
+    user_id = query.from_user.id
     
-    report_data = reports.get(account)
+    # Retrieve stored reports, falling back to the report history (e.g. after a restart)
+    stored = report_store.get(user_id, account)
+    if not stored:
+        stored = await run_blocking(report_history.executor, report_history.latest, user_id, account)
+        if stored:
+            remember_report(user_id, account, *stored)
+    report_data = stored[0] if stored else None
+
     if not report_data:
         await query.edit_message_text(
             f"*Report data for {account} not found. Please refetch.*",
@@ -1272,7 +4115,8 @@ async def handle_currency_navigation(update: Update, context: ContextTypes.DEFAU
         )
         return
     
-    current_index = currencies.index(current_currency)
+    # The stored report may not have the button's currency (e.g. restored from history)
+    current_index = currencies.index(current_currency) if current_currency in currencies else 0
     
     # Determine new currency
     if direction == 'next':
@@ -1281,19 +4125,34 @@ async def handle_currency_navigation(update: Update, context: ContextTypes.DEFAU
         new_index = (current_index - 1) % len(currencies)
     
     new_currency = currencies[new_index]
+    context.user_data.setdefault('currency', {})[account] = new_currency
+
+    # Lazy currency mode: scrape this currency now that it's wanted
+    if report_data[new_currency] is None:
+        creds = await accounts_db.get_account_credentials(user_id, account)
+        if not creds:
+            await query.edit_message_text(f"*Account `{account}` not found*", parse_mode="Markdown")
+            return
+        job = scheduler.submit(user_id, scrape_currency, creds['username'], creds['password'], user_id, new_currency)
+        await query.edit_message_text(
+            f"*Fetching {account} ({new_currency})...{queue_note(job)}*",
+            parse_mode="Markdown",
+            reply_markup=report_markup(account, new_currency, len(currencies))
+        )
+        report = await job.future
+        if report is None:
+            await query.edit_message_text(
+                f"*Failed to fetch {account} ({new_currency})*",
+                parse_mode="Markdown",
+                reply_markup=report_markup(account, new_currency, len(currencies))
+            )
+            return
+        report_store.update(user_id, account, new_currency, report)
+        report_data = {**report_data, new_currency: report}
     
-    # Format report for new currency
-    report = format_report(report_data[new_currency], account, new_currency, last_update=query.message.date)
-    
-    # Update navigation buttons
-    keyboard = [
-        [
-            InlineKeyboardButton("❮❮❮", callback_data=f"nav:{account}:{new_currency}:prev"),
-            InlineKeyboardButton(new_currency, callback_data="none"),
-            InlineKeyboardButton("❯❯❯", callback_data=f"nav:{account}:{new_currency}:next")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Rendered once per currency, then reused on every press
+    rendered = report_store.render(user_id, account, new_currency)
+    report, reply_markup = rendered or render_account_report(account, report_data, stored[1], new_currency)
     
     # Edit existing message with new content
     try:
@@ -1309,10 +4168,27 @@ async def handle_currency_navigation(update: Update, context: ContextTypes.DEFAU
         else:
             logger.error(f"Error editing message: {str(e)}")
 
+async def show_trend(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send today-vs-yesterday and end-of-day figures for a report's currency from history"""
+    query = update.callback_query
+    await query.answer()
+    _, account, currency = query.data.split(':', 2)
+
+    try:
+        text = await run_blocking(report_history.executor, load_trend, query.from_user.id, account, currency)
+    except Exception as e:
+        logger.error(f"Error loading trend for {account}: {str(e)}")
+        text = None
+
+    await query.message.reply_text(
+        text or f"*No history for `{account}` yet. Fetch it a few times first.*",
+        parse_mode="Markdown"
+    )
+
 async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all accounts for the user"""
     user_id = update.message.from_user.id
-    accounts = get_user_accounts(user_id)
+    accounts = await accounts_db.get_user_accounts(user_id)
     
     if not accounts:
         await update.message.reply_text(
@@ -1326,9 +4202,27 @@ async def list_accounts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+async def on_startup(application: Application):
+    """Start background jobs once the bot's event loop is running"""
+    if PREFETCH_ENABLED:
+        application.create_task(prefetch_loop(application))
+
 def main():
     """Start the bot"""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    start_status_page()
+    if LAZY_CURRENCIES:
+        threading.Thread(target=warm_sessions.reap_loop, daemon=True).start()
+
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .rate_limiter(send_limiter)   # every send and edit goes through the flood control
+        .concurrent_updates(update_processor)
+        .persistence(persistence)     # None when PERSIST_STATE is off
+        .post_init(on_startup)
+        .build()
+    )
     
     # Add conversation handler for adding and removing accounts
     conv_handler = ConversationHandler(
@@ -1341,7 +4235,9 @@ def main():
             PASSWORD: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_password)],
             REMOVE_USERNAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_remove_username)]
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="accounts",
+        persistent=persistence is not None
     )
     
     # Add handlers with proper indentation
@@ -1351,15 +4247,25 @@ def main():
     application.add_handler(CommandHandler("accounts", list_accounts))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("report", report_command))
+    application.add_handler(CommandHandler("prefetch", prefetch_command))
     application.add_handler(CommandHandler("cancel", cancel))
     
     # Add handler for account selection
-    application.add_handler(CallbackQueryHandler(fetch_account_report, pattern="^fetch_"))
+    # Non-blocking: a fetch streams for several seconds and must not hold an update slot
+    application.add_handler(CallbackQueryHandler(fetch_account_report, pattern="^(fetch|refresh)_", block=False))
     
     # Add handler for currency navigation
-    application.add_handler(CallbackQueryHandler(handle_currency_navigation, pattern="^nav:"))
+    # Non-blocking: in lazy currency mode navigating can start a scrape
+    application.add_handler(CallbackQueryHandler(handle_currency_navigation, pattern="^nav:", block=False))
+    application.add_handler(CallbackQueryHandler(show_trend, pattern="^trend:"))
     application.add_error_handler(error_handler)
-    application.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["check-parity"]:
+        # python bot.py check-parity [dir]: compare parsers on pages saved via SNAPSHOT_DIR
+        sys.exit(1 if check_snapshot_parity(sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_DIR) else 0)
     main()
\ No newline at end of file
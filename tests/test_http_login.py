@@ -0,0 +1,76 @@
+"""http_login() against a local stand-in for e2.partners' login.jsp"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+import bot
+
+LOGIN_FORM = """<html><body>{notice}
+<form method="post" action="login.jsp">
+  <input name="userId"><input type="password" name="password"><input type="hidden" name="token" value="1">
+</form></body></html>"""
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """pw logs in, wrong is refused with an error message, anything else gets a captcha step"""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body="", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/html")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_GET(self):
+        if self.path.startswith("/page/affiliate/index.jsp"):
+            if "sid=1" in self.headers.get("Cookie", ""):
+                self.reply(200, "<html><body><span id='thisPeriodCommission'>$1.00</span></body></html>")
+            else:
+                self.reply(302, headers=[("Location", "/page/affiliate/login.jsp")])
+        else:
+            self.reply(200, LOGIN_FORM.format(notice='<div class="error"></div>'))
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        password = form["password"][0]
+        if password == "pw":
+            self.reply(302, headers=[("Location", "/page/affiliate/index.jsp"), ("Set-Cookie", "sid=1; Path=/")])
+        elif password == "wrong":
+            self.reply(200, LOGIN_FORM.format(notice='<div class="error">Invalid user ID or password</div>'))
+        else:
+            self.reply(200, LOGIN_FORM.format(notice='<div id="captcha">Verify you are human</div>'))
+
+
+@pytest.fixture(scope="module")
+def e2():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture
+def session(e2, monkeypatch):
+    monkeypatch.setattr(bot, "LOGIN_URL", f"{e2}/page/affiliate/login.jsp")
+    monkeypatch.setattr(bot, "DASHBOARD_URL", f"{e2}/page/affiliate/index.jsp")
+    return bot.new_http_session()
+
+
+def test_login_reaches_dashboard(session):
+    resp = bot.http_login(session, "demo_aff", "pw")
+    assert "index.jsp" in resp.url
+
+
+def test_error_message_rejects_login(session):
+    with pytest.raises(bot.LoginRejected):
+        bot.http_login(session, "demo_aff", "wrong")
+
+
+def test_login_page_without_error_leaves_it_to_the_browser(session):
+    assert bot.http_login(session, "demo_aff", "needs-captcha") is None
@@ -0,0 +1,28 @@
+"""The HTML parser must read saved dashboards the way element scraping does.
+
+Each fixtures/dashboard/<name>.html has a <name>.json next to it holding what
+snapshot_dashboard_elements() reads off that page in Chrome. Add a pair (pages
+saved via SNAPSHOT_DIR) whenever the dashboard changes shape.
+"""
+import json
+from pathlib import Path
+
+import pytest
+
+import bot
+
+FIXTURES = Path(__file__).parent / "fixtures" / "dashboard"
+PAGES = sorted(path.stem for path in FIXTURES.glob("*.json"))
+
+
+@pytest.mark.parametrize("name", PAGES)
+def test_html_parser_matches_element_scraping(name):
+    snapshot = bot.snapshot_dashboard_html((FIXTURES / f"{name}.html").read_text(encoding="utf-8"))
+    reference = json.loads((FIXTURES / f"{name}.json").read_text(encoding="utf-8"))
+
+    assert snapshot is not None
+    assert bot.check_parity("html", bot.build_currency_report(snapshot), bot.build_currency_report(reference))
+
+
+def test_non_dashboard_page_is_rejected():
+    assert bot.snapshot_dashboard_html((FIXTURES / "login_page.html").read_text(encoding="utf-8")) is None